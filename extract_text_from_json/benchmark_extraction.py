@@ -0,0 +1,179 @@
+import os
+import sys
+import gzip
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import ujson as json
+import tweetData
+import tweetURLData
+import extract_full_tweet_from_json
+
+# Measures the extraction path of extract_full_tweet_from_json.py one stage at a time: tweets/sec and peak memory
+# for each of
+#   read        reading and decompressing lines
+#   json        json.loads
+#   tweet_info  tweetData.extract_tweet_info (the tweet-level fields)
+#   urls        tweetURLData.extract_urls_from_tweet, without the newline/tab escaping (escape_text=False)
+#   escape      tweetURLData.extract_urls_from_tweet with escaping, as for the TSV (compare with urls for the
+#               cost of escaping)
+#   write       writing the rows to a gzipped TSV (as extract_full_tweet_from_json.py does)
+#   total       read, json, escape and write together
+# Each stage runs in its own process, which reads the input again and does the earlier stages untimed, so the
+# peak RSS reported for a stage is that of a process running only up to that stage (plus the interpreter baseline,
+# reported as "baseline"). Input is processed in batches, and only the stage itself is inside the timer.
+#
+# Synthetic input can be made with ../gather_example_data/generate_synthetic_data.py.
+#
+# Usage: python benchmark_extraction.py [--max-tweets N] [--stages json,urls,...] <inFile.json.gz>
+
+STAGES = ['read', 'json', 'tweet_info', 'urls', 'escape', 'write', 'total']
+BATCH_SIZE = 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark each stage of tweet extraction on a gzipped JSON file.")
+    parser.add_argument('input', metavar='inFile.json.gz')
+    parser.add_argument('--max-tweets', type=int, default=0, help="stop after this many lines (default: whole file)")
+    parser.add_argument('--stages', default=','.join(STAGES), help="comma-separated subset of: " + ', '.join(STAGES))
+    parser.add_argument('--results-file', help="also write the results to this file, as JSON")
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error("unknown stage '%s'" % stage)
+
+    results = [run_in_child(baseline_rss)]
+    results[0]['stage'] = 'baseline'
+    for stage in stages:
+        result = run_in_child(run_stage, stage, args.input, args.max_tweets)
+        result['stage'] = stage
+        results.append(result)
+
+    print "%-11s %10s %12s %12s %14s" % ('stage', 'tweets', 'seconds', 'tweets/sec', 'peak RSS (MB)')
+    for result in results:
+        if result['stage'] == 'baseline':
+            print "%-11s %10s %12s %12s %14.1f" % ('baseline', '', '', '', result['peak_rss_mb'])
+        else:
+            print "%-11s %10d %12.2f %12.0f %14.1f" % (result['stage'], result['tweets'], result['seconds'],
+                                                      result['tweets'] / result['seconds'] if result['seconds'] else 0,
+                                                      result['peak_rss_mb'])
+    if args.results_file:
+        with open(args.results_file, 'w') as fout:
+            json.dump(results, fout, indent=2)
+
+
+# Runs func(*args) in a fresh process and returns its result (a dict), adding the process's peak RSS.
+def run_in_child(func, *args):
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    proc = multiprocessing.Process(target=child_main, args=(child_conn, func, args))
+    proc.start()
+    child_conn.close()
+    result = parent_conn.recv()
+    proc.join()
+    if 'error' in result:
+        sys.exit("stage failed: " + result['error'])
+    return result
+
+
+def child_main(conn, func, args):
+    try:
+        result = func(*args)
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0   # KB on Linux
+    except Exception as e:
+        result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+    conn.send(result)
+    conn.close()
+
+
+def baseline_rss():
+    return {}
+
+
+def read_batches(input_path, max_tweets):
+    batch = []
+    n = 0
+    with gzip.open(input_path, 'r') as fin:
+        for line in fin:
+            batch.append(line)
+            n += 1
+            if len(batch) >= BATCH_SIZE:
+                yield batch
+                batch = []
+            if max_tweets and n >= max_tweets:
+                break
+    if batch:
+        yield batch
+
+
+def run_stage(stage, input_path, max_tweets):
+    extract_args = dict(extract_full_tweet_from_json.EXTRACT_ARGS)
+    n_tweets = 0
+    elapsed = 0.0
+
+    out_dir = tempfile.mkdtemp()
+    out_path = os.path.join(out_dir, 'out.tsv.gz')
+    fout = gzip.open(out_path, 'wb')
+    wrtr = extract_full_tweet_from_json.TSVWriter(fout)
+    wrtr.writerow(tweetURLData.URL_FIELDS)
+
+    batches = read_batches(input_path, max_tweets)
+    while True:
+        start = time.time()
+        batch = next(batches, None)
+        if stage in ('read', 'total'):
+            elapsed += time.time() - start
+        if batch is None:
+            break
+        n_tweets += len(batch)
+        if stage == 'read':
+            continue
+
+        start = time.time()
+        tweets = [json.loads(line) for line in batch]
+        if stage in ('json', 'total'):
+            elapsed += time.time() - start
+        if stage == 'json':
+            continue
+
+        if stage == 'tweet_info':
+            start = time.time()
+            for t in tweets:
+                tweetData.extract_tweet_info(t)
+            elapsed += time.time() - start
+            continue
+
+        if stage == 'urls':
+            start = time.time()
+            for t in tweets:
+                tweetURLData.extract_urls_from_tweet(t, escape_text=False, **extract_args)
+            elapsed += time.time() - start
+            continue
+
+        start = time.time()
+        rows = []
+        for t in tweets:
+            rows.extend(tweetURLData.extract_urls_from_tweet(t, **extract_args))
+        if stage in ('escape', 'total'):
+            elapsed += time.time() - start
+        if stage == 'escape':
+            continue
+
+        start = time.time()
+        wrtr.writerows(rows)
+        elapsed += time.time() - start
+
+    start = time.time()
+    fout.close()
+    if stage in ('write', 'total'):
+        elapsed += time.time() - start
+    os.remove(out_path)
+    os.rmdir(out_dir)
+    return {'tweets': n_tweets, 'seconds': elapsed}
+
+
+if __name__ == "__main__":
+    main()
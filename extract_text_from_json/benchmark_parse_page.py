@@ -0,0 +1,58 @@
+import glob
+import time
+import argparse
+import expandURLs
+
+# Compares expandURLs.parse_page (full DOM + CSS selectors) with expandURLs.parse_page_head (incremental, head only)
+# on a corpus of saved pages: reports pages/sec and MB/sec for each, and any pages where the results differ.
+#
+# Usage: python benchmark_parse_page.py [--repeat N] <page.html> [<page2.html> ...]   (or a quoted glob, e.g. 'pages/*.html')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark parse_page against parse_page_head on saved html pages.")
+    parser.add_argument('pages', nargs='+', help="saved html files (globs are expanded)")
+    parser.add_argument('--repeat', type=int, default=3, help="times to parse the corpus with each parser (default %(default)s)")
+    args = parser.parse_args()
+
+    paths = []
+    for pattern in args.pages:
+        paths.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as fin:
+            pages.append((path, fin.read()))
+    n_bytes = sum(len(html) for path, html in pages)
+    print "%d pages, %.1f MB" % (len(pages), n_bytes / 1e6)
+
+    # correctness first
+    n_diffs = 0
+    for path, html in pages:
+        try:
+            expected = expandURLs.parse_page(html)
+        except Exception as e:
+            expected = e.__class__.__name__
+        try:
+            actual = expandURLs.parse_page_head(html)
+        except Exception as e:
+            actual = e.__class__.__name__
+        if expected != actual:
+            n_diffs += 1
+            print "DIFF %s\n  parse_page:      %r\n  parse_page_head: %r" % (path, expected, actual)
+    print "%d of %d pages differ" % (n_diffs, len(pages))
+
+    for name, func in [('parse_page', expandURLs.parse_page), ('parse_page_head', expandURLs.parse_page_head)]:
+        start = time.time()
+        for i in xrange(args.repeat):
+            for path, html in pages:
+                try:
+                    func(html)
+                except Exception:
+                    pass
+        elapsed = time.time() - start
+        print "%-16s %8.1f pages/sec %8.1f MB/sec" % (name, args.repeat * len(pages) / elapsed,
+                                                     args.repeat * n_bytes / 1e6 / elapsed)
+
+
+if __name__ == "__main__":
+    main()
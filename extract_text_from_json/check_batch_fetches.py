@@ -0,0 +1,69 @@
+import sys
+import json
+import argparse
+import tempfile
+import expandURLs
+import fetchPlanner
+import fake_page_server
+
+# Checks how much network work the batch functions do, against fake_page_server.py's made-up hosts (started here,
+# in this process): counts the GETs and HEADs each batch sends, and compares them with what it should send.
+#   -fastOnlyExpandURL, with or without a planner: HEADs only, no page downloaded (not even where a redirector led)
+#   -a planner without fastOnlyExpandURL: pages downloaded, including redirectors' landing pages
+#   -the planner's counts add up to the distinct URLs of the batch (landing pages are counted as landing_fetches)
+# 127.1 (another name for 127.0.0.1) is the redirector, per the planner config written here, and 127.0.0.1 the hosts
+# it redirects to.
+#
+# Usage: python check_batch_fetches.py [--port 8100]
+# Prints a line per batch and exits with status 1 if any check fails.
+
+N_HOSTS = 3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the GETs and HEADs sent by expandURLs' batch functions.")
+    parser.add_argument('--port', type=int, default=8100, help="port of the first made-up host (default %(default)s)")
+    args = parser.parse_args()
+
+    stats = fake_page_server.start_hosts(args.port, [0] * N_HOSTS, [0] * N_HOSTS)
+    pages = ['http://127.0.0.1:%d/page/p%d' % (args.port + i % N_HOSTS, i) for i in range(12)]
+    redirected = ['http://127.1:%d/redirect-host/%d/page/r%d' % (args.port, i % N_HOSTS, i) for i in range(6)]
+    urls = pages + redirected + pages[:3]
+
+    config = tempfile.NamedTemporaryFile(suffix='.json')
+    json.dump({'domains': {'127.1': {'action': 'resolve', 'redirector': True}}}, config)
+    config.flush()
+
+    failures = 0
+    for name, batch, fast_only, use_planner in [
+            ('fetch_html_batch, fast only', expandURLs.fetch_html_batch, True, False),
+            ('fetch_html_batch, fast only, planner', expandURLs.fetch_html_batch, True, True),
+            ('expand_url_batch, fast only, planner', expandURLs.expand_url_batch, True, True),
+            ('expand_url_batch, planner', expandURLs.expand_url_batch, False, True)]:
+        planner = fetchPlanner.FetchPlanner(config.name) if use_planner else None
+        before = stats.as_dict()
+        results = list(batch(urls, num_threads=8, fastOnlyExpandURL=fast_only, planner=planner))
+        after = stats.as_dict()
+        gets = sum(after[host]['gets'] - before[host]['gets'] for host in after)
+        heads = sum(after[host]['heads'] - before[host]['heads'] for host in after)
+        downloaded = sum(1 for res in results if 'html' in res or 'title' in res)
+
+        problems = []
+        if fast_only and (gets or downloaded):
+            problems.append("pages downloaded")
+        if not fast_only and downloaded != len(urls):
+            problems.append("%d of %d pages downloaded" % (downloaded, len(urls)))
+        if planner is not None:
+            counts = planner.stats()
+            n_planned = counts[fetchPlanner.SKIP] + counts[fetchPlanner.RESOLVE] + counts[fetchPlanner.FETCH]
+            if n_planned != len(set(urls)):
+                problems.append("%d URLs planned for %d distinct ones" % (n_planned, len(set(urls))))
+            if counts['landing_fetches'] != (0 if fast_only else len(redirected)):
+                problems.append("%d landing pages fetched" % counts['landing_fetches'])
+        failures += bool(problems)
+        print "%-40s %3d GETs %3d HEADs  %s" % (name, gets, heads, '; '.join(problems) or 'ok')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
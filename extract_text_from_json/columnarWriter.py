@@ -0,0 +1,94 @@
+from tweetData import parse_tweet_datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Parquet output for the extractor, as an alternative to the gzipped TSV.
+# Columns are typed (IDs as int64, tweet_date as a UTC timestamp, classifier_label as boolean, classifier scores as
+# float64, everything else text), so later jobs can read just the columns they need
+# (e.g., pq.read_table(path, columns=['tweet_id', 'canonical_url'])) and skip row groups by tweet_date using the
+# min/max statistics stored for each one.
+# Text is stored as is: rows should come from the extract functions with escape_text=False.
+# Needs pyarrow (pip install pyarrow).
+
+INT_FIELDS = set(['tweet_id', 'user_id', 'retweet_of_tweet_id', 'retweet_of_user_id', 'quote_of_tweet_id', 'reply_to_tweet_id'])
+DATE_FIELDS = set(['tweet_date'])
+BOOL_FIELDS = set(['classifier_label'])
+FLOAT_FIELDS = set(['raw_classifier_score', 'classifier_score'])
+# low-cardinality columns, stored with dictionary encoding
+DICTIONARY_FIELDS = ['website', 'link_type', 'where_url_found']
+
+DEFAULT_ROW_GROUP_SIZE = 100000
+
+
+def field_type(field):
+    if field in INT_FIELDS:
+        return pa.int64()
+    if field in DATE_FIELDS:
+        return pa.timestamp('s', tz='UTC')
+    if field in BOOL_FIELDS:
+        return pa.bool_()
+    if field in FLOAT_FIELDS:
+        return pa.float64()
+    return pa.string()
+
+
+# Empty strings (how the extractor marks a missing ID, etc.) become nulls in typed columns.
+def convert_value(field, value):
+    if value is None or value == '':
+        return None
+    if field in INT_FIELDS:
+        return int(value)
+    if field in DATE_FIELDS:
+        return parse_tweet_datetime(value)
+    if field in BOOL_FIELDS:
+        return value == 'TRUE'
+    if field in FLOAT_FIELDS:
+        return float(value)
+    return value
+
+
+class ParquetRowWriter(object):
+    """ Writes rows (tuples in the order of fieldnames, as returned by tweetURLData.extract_urls_from_tweet or
+        extract_tweet_row) to a Parquet file, buffering up to row_group_size rows per row group. Has the
+        writerow/writerows interface of csv.writer; call close() when done. """
+
+    def __init__(self, path, fieldnames, row_group_size=DEFAULT_ROW_GROUP_SIZE, compression='snappy'):
+        if pa is None:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+        self.fieldnames = list(fieldnames)
+        self.row_group_size = row_group_size
+        self.schema = pa.schema([pa.field(f, field_type(f)) for f in self.fieldnames])
+        self.writer = pq.ParquetWriter(path, self.schema, compression=compression,
+                                       use_dictionary=[f for f in DICTIONARY_FIELDS if f in self.fieldnames])
+        self.columns = [[] for f in self.fieldnames]
+        self.n_buffered = 0
+
+    def writeheader(self):
+        pass   # the schema serves as the header
+
+    def writerow(self, row):
+        for field, column, value in zip(self.fieldnames, self.columns, row):
+            column.append(convert_value(field, value))
+        self.n_buffered += 1
+        if self.n_buffered >= self.row_group_size:
+            self.flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        if not self.n_buffered:
+            return
+        arrays = [pa.array(column, type=field.type) for column, field in zip(self.columns, self.schema)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=self.row_group_size)
+        self.columns = [[] for f in self.fieldnames]
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
@@ -1,45 +1,53 @@
 import re
+import sys
+import time
+import Queue
+import threading
+import collections
+import urlparse
 import requests
 import lxml.html
+import lxml.etree
 from lxml.cssselect import CSSSelector
+from multiprocessing.pool import ThreadPool
 
 URL_PATTERN = re.compile('https?://([^/]+)')
 
 class TimeoutError(Exception):
-    """ Timeout function modified from:
-        http://stackoverflow.com/questions/492519/timeout-on-a-function-call
-        and http://stackoverflow.com/questions/11901328/how-to-timeout-function-in-python-timeout-less-than-a-second
-    """
+    """ Raised when reading a page's content takes longer than its deadline. """
     pass
 
 
-def timeout(func, args=(), kwargs=None, timeout_duration=1, default=None, throw_exception=False):
-    kwargs = kwargs or {}
+# Bytes requested from the socket at a time when reading page content
+READ_CHUNK_SIZE = 4096
+HEAD_END_PATTERN = re.compile(r'</head|<body', re.IGNORECASE)
 
-    import signal
 
-    def handler(signum, frame):
-        raise TimeoutError()
-
-    # set the timeout handler
-    old_handler = signal.signal(signal.SIGALRM, handler)
-    # signal.alarm(timeout_duration)    # this one only allows integer timeout
-    # values
-    signal.setitimer(signal.ITIMER_REAL, timeout_duration)
-    try:
-        result = func(*args, **kwargs)
-    except TimeoutError as exc:
-        result = default
-        if throw_exception:
-            raise exc
-    finally:
-        signal.alarm(0)
-        signal.signal(signal.SIGALRM, old_handler)
-
-    return result
+def read_page_content(r, max_bytes=1000000, deadline=10, head_only=True):
+    """ Reads the body of a streamed response (requests.get(..., stream=True)) in chunks.
+        Stops after max_bytes, or as soon as the end of <head> has arrived if head_only (parse_page only looks
+        in the head). Raises TimeoutError if reading takes more than deadline seconds in total; each
+        individual read is also bounded by the request's own timeout. Thread-safe (no signals). """
+    stop_time = time.time() + deadline
+    chunks = []
+    n_bytes = 0
+    tail = ''   # end of the previous chunk, in case the end-of-head tag is split across chunks
+    for chunk in r.iter_content(chunk_size=READ_CHUNK_SIZE):
+        if time.time() > stop_time:
+            raise TimeoutError()
+        chunks.append(chunk)
+        n_bytes += len(chunk)
+        if n_bytes >= max_bytes:
+            break
+        if head_only:
+            if HEAD_END_PATTERN.search(tail + chunk) is not None:
+                break
+            tail = chunk[-5:]
+    return ''.join(chunks)[:max_bytes]
 
 
-def fetch_html(expanded_url, turnOffSSL=False, fastOnlyExpandURL=False):
+def fetch_html(expanded_url, turnOffSSL=False, fastOnlyExpandURL=False, session=None, request_timeout=5,
+               max_page_bytes=1000000, read_deadline=10, head_only=True, stats=None):
     """ Fetches the html of a url, following redirects and all.
         Handles three types of errors:
         1. Error reaching final page (malformed website; HTTP errors in any of the redirects or
@@ -47,60 +55,98 @@ def fetch_html(expanded_url, turnOffSSL=False, fastOnlyExpandURL=False):
         2. Error downloading page content or determining encoding (certain large non-html files
            take up ridiculous amounts of time and memory when r.text is called)
         3. Errors reading html (e.g., malformed Unicode or more encoding errors)
+        If the SSL certificate can't be verified, tries once more with verification turned off.
+        session: a requests.Session to send requests through (so connections can be reused);
+           default is a fresh connection for each request.
+        request_timeout: seconds to wait on connecting or on each read, per request.
+        max_page_bytes, read_deadline, head_only: limits on downloading the page; see read_page_content().
+        stats: a pipelineStats.PipelineStats, to record the outcome of the fetch (see fetch_outcome) and
+           how long it took.
         Returns a dictionary that contains:
         'landing_url' - the url after following all redirects
+        'status_code' - HTTP status at the landing url
         'err' - if something went wrong
         'is_html' - 1/0 if content type is html
-        'content_length' - when too large (>1000000)
-        'html' - the html content! """
+        'content_length' - from the header, if given
+        'html' - the html content! (or just its <head>, if head_only) """
+    start = time.time()
+    res = _fetch_html(expanded_url, turnOffSSL, fastOnlyExpandURL, session, request_timeout,
+                      max_page_bytes, read_deadline, head_only)
+    if stats is not None:
+        stats.observe_fetch(fetch_outcome(res), time.time() - start)
+    return res
+
+
+# Classifies fetch_html's result for stats: 'ok', 'HTTP 4xx'/'HTTP 5xx'/..., or the exception class name
+# (e.g. 'ReadTimeout', 'ConnectionError', 'TimeoutError' for the read deadline).
+def fetch_outcome(res):
+    err = res.get('err')
+    if err is None:
+        return 'ok'
+    if err.startswith('HTTP status '):
+        return 'HTTP ' + err[len('HTTP status '):][:1] + 'xx'
+    if err == 'Timed out while reading page content':
+        return 'TimeoutError'
+    return err.split(':', 1)[0]
+
+
+def _fetch_html(expanded_url, turnOffSSL, fastOnlyExpandURL, session, request_timeout,
+                max_page_bytes, read_deadline, head_only):
+    http = session if session is not None else requests
     res = {}
-    try:
-        # Just use head for now: it's faster
-        rh = requests.head(expanded_url, timeout=5,
-                           allow_redirects=True, verify=not turnOffSSL)
-        # special case for 405, Method not allowed -- it might simply not
-        # support "head." Try the full thing.
-        if rh.status_code == 405:
-            rh = requests.get(expanded_url, timeout=5, verify=not turnOffSSL)
-        if rh.status_code != requests.codes.ok:
-            res['err'] = "HTTP status " + str(rh.status_code)
-        if rh.url is not None:
-            res['landing_url'] = rh.url
-    except requests.exceptions.SSLError as e:
-        if not turnOffSSL:
-            return fetch_html(expanded_url, turnOffSSL=True, fastOnlyExpandURL=fastOnlyExpandURL)
-        # still gives an error, even with the flag
-        res['err'] = e.__class__.__name__ + ": " + str(e.message)
-    except requests.exceptions.RequestException as e:
-        # These are commonly ReadTimeout or ConnectionError (for invalid URLs)
-        res['err'] = e.__class__.__name__ + ": " + str(e.message)
+    verify = not turnOffSSL
+    while True:
+        try:
+            # Just use head for now: it's faster
+            rh = http.head(expanded_url, timeout=request_timeout,
+                           allow_redirects=True, verify=verify)
+            # special case for 405, Method not allowed -- it might simply not
+            # support "head." Try the full thing.
+            if rh.status_code == 405:
+                rh = http.get(expanded_url, timeout=request_timeout, verify=verify)
+            res['status_code'] = rh.status_code
+            if rh.status_code != requests.codes.ok:
+                res['err'] = "HTTP status " + str(rh.status_code)
+            if rh.url is not None:
+                res['landing_url'] = rh.url
+        except requests.exceptions.SSLError as e:
+            if verify:
+                verify = False
+                continue
+            # still gives an error, even with the flag
+            res['err'] = e.__class__.__name__ + ": " + str(e.message)
+        except requests.exceptions.RequestException as e:
+            # These are commonly ReadTimeout or ConnectionError (for invalid URLs)
+            res['err'] = e.__class__.__name__ + ": " + str(e.message)
+        break
 
     if 'err' in res:
         return res
 
-    # Will only download the page if it's html and not too large (1MB or more - probably not HTML)
+    # Will only download the page if it's html. (Large pages are fine, since the download is capped.)
     res['is_html'] = int('html' in rh.headers.get('content-type', 'html').lower())
     res['content_length'] = int(rh.headers.get('content-length', '-1'))
-    if res['is_html'] == 0 or res['content_length'] >= 1000000 or fastOnlyExpandURL:
+    if res['is_html'] == 0 or fastOnlyExpandURL:
         return res
 
     # Go for more fields!
     try:
         # hopefully can still hit the page we hit above
-        r = requests.get(res.get('landing_url', expanded_url), timeout=5, verify=not turnOffSSL)
-        if r.status_code != requests.codes.ok:
-            res['err'] = "HTTP status " + str(r.status_code)
-            return res
-
-        # This is where URLs may take a long time & memory. Time out after 10 sec.
-        # Switched to calling r.content instead of r.text ==> html parser will handle encoding.
-        res['html'] = timeout(requests.Response.content.__get__, args=[r],
-                              timeout_duration=10, throw_exception=True)
+        r = http.get(res.get('landing_url', expanded_url), timeout=request_timeout, verify=verify, stream=True)
+        try:
+            res['status_code'] = r.status_code
+            if r.status_code != requests.codes.ok:
+                res['err'] = "HTTP status " + str(r.status_code)
+                return res
+
+            # This is where URLs may take a long time & memory, so the download is bounded in size and time.
+            # Reading raw bytes instead of r.text ==> html parser will handle encoding.
+            res['html'] = read_page_content(r, max_bytes=max_page_bytes, deadline=read_deadline, head_only=head_only)
+        finally:
+            r.close()
         if len(res['html']) < 1:
             res['err'] = 'empty page'
             del res['html']
-        # else:
-        #     res['html'] = unicode(res['html'].encode('utf8'))
     except TimeoutError:
         res['err'] = 'Timed out while reading page content'
     except Exception as e:
@@ -110,6 +156,174 @@ def fetch_html(expanded_url, turnOffSSL=False, fastOnlyExpandURL=False):
     return res
 
 
+def expand_url(expanded_url, **fetch_args):
+    """ fetch_html followed by parse_page (well, parse_page_head, which gives the same results faster).
+        Returns fetch_html's dictionary, with the parsed fields ('title', 'description', etc.) in place
+        of the html itself. Takes the same keyword args as fetch_html (with stats, also records the time
+        spent parsing, as stage 'parse_page'). """
+    res = fetch_html(expanded_url, **fetch_args)
+    html = res.pop('html', None)
+    if html is not None:
+        start = time.time()
+        try:
+            res.update(parse_page_head(html))
+        except Exception as e:
+            res['err'] = e.__class__.__name__ + ": " + str(e.message)
+        if fetch_args.get('stats') is not None:
+            fetch_args['stats'].add_time('parse_page', time.time() - start)
+    return res
+
+
+def fetch_html_batch(expanded_urls, num_threads=32, max_per_host=4, request_timeout=5,
+                     turnOffSSL=False, fastOnlyExpandURL=False, stats=None, planner=None):
+    """ Calls fetch_html on many urls at once, using a pool of threads.
+        At most num_threads requests are in flight overall, and at most max_per_host to any one host
+        (judged by the host of the url passed in, before redirects). Urls whose host is at its limit wait
+        without holding up the threads, so other hosts' urls further on go ahead of them. Each thread keeps
+        its own requests.Session, so keep-alive connections get reused across urls.
+        expanded_urls: any iterable of urls.
+        stats: passed on to fetch_html.
+        planner: optionally, a fetchPlanner.FetchPlanner, to decide per url whether to skip it, only
+           resolve its redirects (as with fastOnlyExpandURL), or fetch it fully, and to order the work
+           by host. It also learns from the results. With fastOnlyExpandURL, it never fetches fully.
+        Returns an iterator over fetch_html's result dictionaries, in the same order as expanded_urls. """
+    def fetch(url, session, fast_only=fastOnlyExpandURL):
+        return fetch_html(url, turnOffSSL=turnOffSSL, fastOnlyExpandURL=fast_only,
+                          session=session, request_timeout=request_timeout, stats=stats)
+    return _run_planned_batch(fetch, expanded_urls, num_threads, max_per_host, planner=planner,
+                              fast_only=fastOnlyExpandURL)
+
+
+def expand_url_batch(expanded_urls, cache=None, num_threads=32, max_per_host=4, request_timeout=5,
+                     turnOffSSL=False, fastOnlyExpandURL=False, stats=None, planner=None):
+    """ Like fetch_html_batch, but calls expand_url. Results are those of expand_url (no html).
+        cache: optionally, a urlCache.URLCache. Urls found there don't touch the network (they take one of
+           their host's slots only while being looked up), and each distinct url is fetched only once even
+           if it appears many times in expanded_urls. """
+    def fetch(url, session, fast_only=fastOnlyExpandURL):
+        return expand_url(url, turnOffSSL=turnOffSSL, fastOnlyExpandURL=fast_only,
+                          session=session, request_timeout=request_timeout, stats=stats)
+    return _run_planned_batch(fetch, expanded_urls, num_threads, max_per_host, cache=cache, planner=planner,
+                              fast_only=fastOnlyExpandURL)
+
+
+def _run_planned_batch(fetch, urls, num_threads, max_per_host, cache=None, planner=None, fast_only=False):
+    if planner is None:
+        return _run_batch(fetch, urls, num_threads, max_per_host, cache=cache, is_fast_only=lambda url: fast_only)
+    return planner.run_batch(fetch, urls, lambda planned_fetch, ordered_urls, is_fast_only:
+                             _run_batch(planned_fetch, ordered_urls, num_threads, max_per_host, cache=cache,
+                                        is_fast_only=is_fast_only), fast_only=fast_only)
+
+
+# Urls taken from the input ahead of the next result to come out, per thread: room for other hosts' urls to
+# go ahead while one host's wait for a free slot
+LOOKAHEAD_PER_THREAD = 32
+
+
+# Thread pool behind the *_batch functions. fetch(url, session) does the work for one url; is_fast_only(url) says
+# whether that only resolves its redirects, which decides what a cached result needs to have come from.
+# The calling thread hands a url to the pool only once its host has a free slot; until then it waits in its host's
+# queue, so a busy host never ties up threads that other hosts' urls could use. With a cache, repeats of a url that's
+# still being looked up or fetched wait for its result instead of taking another slot. (Cache hits do take a slot,
+# but only for as long as the lookup.)
+def _run_batch(fetch, urls, num_threads, max_per_host, cache=None, is_fast_only=lambda url: False):
+    local = threading.local()
+    done = Queue.Queue()
+
+    def fetch_one(task):
+        try:
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=num_threads, pool_maxsize=max_per_host)
+                local.session.mount('http://', adapter)
+                local.session.mount('https://', adapter)
+            if cache is None:
+                outcome = (True, fetch(task.url, local.session))
+            else:
+                outcome = (True, cache.get_or_fetch(task.url, lambda: fetch(task.url, local.session),
+                                                    is_fast_only(task.url)))
+        except Exception:
+            outcome = (False, sys.exc_info())
+        done.put((task, outcome))
+
+    pool = ThreadPool(num_threads)
+    waiting = {}     # host -> deque of tasks waiting for a slot
+    busy = {}        # host -> number of its tasks handed to the pool
+    by_url = {}      # with a cache: url -> its task, until it's done
+    outcomes = {}    # index in urls -> (True, result) or (False, exc_info), until yielded
+
+    def start(task):
+        busy[task.host] = busy.get(task.host, 0) + 1
+        pool.apply_async(fetch_one, (task,))
+
+    try:
+        url_iter = iter(urls)
+        n_taken = 0
+        n_yielded = 0
+        more = True
+        while True:
+            while more and n_taken - n_yielded < num_threads * LOOKAHEAD_PER_THREAD:
+                try:
+                    url = next(url_iter)
+                except StopIteration:
+                    more = False
+                    break
+                task = by_url.get(url)
+                if task is not None:
+                    task.indexes.append(n_taken)
+                else:
+                    task = _BatchTask(url, n_taken)
+                    if cache is not None:
+                        by_url[url] = task
+                    if busy.get(task.host, 0) < max_per_host:
+                        start(task)
+                    else:
+                        waiting.setdefault(task.host, collections.deque()).append(task)
+                n_taken += 1
+
+            while n_yielded in outcomes:
+                ok, value = outcomes.pop(n_yielded)
+                n_yielded += 1
+                if not ok:
+                    raise value[0], value[1], value[2]
+                yield value
+            if not more and n_yielded == n_taken:
+                return
+
+            task, outcome = _wait_for(done)
+            for index in task.indexes:
+                outcomes[index] = outcome
+            by_url.pop(task.url, None)
+            busy[task.host] -= 1
+            host_waiting = waiting.get(task.host)
+            if host_waiting:
+                start(host_waiting.popleft())
+                if not host_waiting:
+                    del waiting[task.host]
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# done.get(), with a timeout so that Ctrl-C gets through while waiting
+def _wait_for(done):
+    while True:
+        try:
+            return done.get(True, 1)
+        except Queue.Empty:
+            pass
+
+
+class _BatchTask(object):
+    """ A url for _run_batch to fetch, and where it appears in the input. """
+    __slots__ = ['url', 'host', 'indexes']
+
+    def __init__(self, url, index):
+        self.url = url
+        self.host = urlparse.urlsplit(url).netloc.lower()
+        self.indexes = [index]
+
+
 meta_selectors = {
     # 'keywords': ['head > meta[name="news_keywords"]', 'head > meta[name="keywords"]'],
     'description': ['head > meta[name="description"]', 'head > meta[property="og:description"]', 'head > meta[name="twitter:description"]', 'head > meta[itemprop="description"]'],
@@ -178,3 +392,122 @@ def parse_page(html, meta_selectors=meta_selectors):
         del res['canonical_url']
 
     return res
+
+
+# parse_page_head: same results as parse_page, but feeds the html to the parser incrementally, stops at the end
+# of <head>, and answers all the selectors in one pass over head's children (without building a tree).
+# Only handles selectors of the forms 'head > tag[attr="value"]' and 'head > tag' (which is all meta_selectors uses).
+HEAD_SELECTOR_PATTERN = re.compile(r'^head\s*>\s*([\w-]+)(?:\[([\w-]+)="([^"]*)"\])?$')
+FEED_CHUNK_SIZE = 4096
+
+head_lookups = {}   # frozen_selectors(meta_selectors) -> compiled lookup table
+
+
+def frozen_selectors(meta_selectors):
+    """ meta_selectors as a hashable key (by content, not id(), which a new dict can reuse once the old one is gone). """
+    return tuple(sorted((prop, tuple(sels)) for prop, sels in meta_selectors.iteritems()))
+
+
+def compile_head_selectors(meta_selectors):
+    """ Returns a dict mapping (tag, attr, value) -- or (tag, None, None) -- to a list of
+        (prop, priority, value_attr), where priority is the selector's position within meta_selectors[prop]. """
+    lookup = {}
+    for prop, sels in meta_selectors.iteritems():
+        for priority, sel in enumerate(sels):
+            m = HEAD_SELECTOR_PATTERN.match(sel)
+            if m is None:
+                raise ValueError("parse_page_head can't handle selector '" + sel + "'; use parse_page instead")
+            tag, attr, value = m.groups()
+            if tag == 'link':
+                value_attr = 'href'
+            elif tag == 'meta':
+                value_attr = 'content'
+            else:
+                value_attr = None
+            lookup.setdefault((tag, attr, value), []).append((prop, priority, value_attr))
+    return lookup
+
+
+class HeadMetaTarget(object):
+    """ lxml parser target that collects, for each prop, the values found by each of its selectors. """
+
+    def __init__(self, lookup):
+        self.lookup = lookup
+        self.stack = []
+        self.done = False
+        self.found = {}           # prop -> {priority -> list of values}
+        self.text_targets = None  # while inside a text-valued element (title): its (prop, priority) pairs
+        self.text = []
+
+    def start(self, tag, attrib):
+        if self.done:
+            return
+        if tag == 'body':
+            self.done = True
+            return
+        if len(self.stack) and self.stack[-1] == 'head':
+            matches = list(self.lookup.get((tag, None, None), []))
+            for attr, value in attrib.items():
+                matches.extend(self.lookup.get((tag, attr, value), []))
+            for prop, priority, value_attr in matches:
+                values = self.found.setdefault(prop, {}).setdefault(priority, [])
+                if value_attr is None:
+                    self.text_targets = (self.text_targets or []) + [(prop, priority)]
+                elif value_attr in attrib:
+                    values.append(bad_chars.sub(' ', attrib[value_attr]).strip())
+        self.stack.append(tag)
+
+    def data(self, data):
+        if self.text_targets is not None:
+            self.text.append(data)
+
+    def end(self, tag):
+        if self.done:
+            return
+        if self.stack:
+            self.stack.pop()
+        if self.text_targets is not None and len(self.stack) and self.stack[-1] == 'head':
+            text = bad_chars.sub(' ', u''.join(self.text)).strip()
+            for prop, priority in self.text_targets:
+                self.found[prop][priority].append(text)
+            self.text_targets = None
+            self.text = []
+        if tag == 'head':
+            self.done = True
+
+    def close(self):
+        return self.found
+
+
+def parse_page_head(html, meta_selectors=meta_selectors):
+    """ Drop-in replacement for parse_page that only parses as far as the end of <head>. """
+    key = frozen_selectors(meta_selectors)
+    lookup = head_lookups.get(key)
+    if lookup is None:
+        lookup = head_lookups[key] = compile_head_selectors(meta_selectors)
+
+    target = HeadMetaTarget(lookup)
+    parser = lxml.etree.HTMLParser(target=target)
+    for start in xrange(0, len(html), FEED_CHUNK_SIZE):
+        parser.feed(html[start:start + FEED_CHUNK_SIZE])
+        if target.done:
+            break
+    try:
+        found = parser.close()
+    except lxml.etree.XMLSyntaxError:
+        found = target.found
+
+    res = {}
+    # for each prop, use the highest-priority selector that matched any elements (as parse_page does)
+    for prop, by_priority in found.iteritems():
+        values = by_priority[min(by_priority)]
+        val = unicode(','.join(values)).encode("utf-8")
+        if len(val) > 0:
+            res[prop] = val
+
+    # If canonical url we extracted is blank or malformed, fall back to the version we know worked
+    if 'canonical_url' in res and \
+       (len(res['canonical_url']) == 0 or URL_PATTERN.match(res['canonical_url']) is None):
+        del res['canonical_url']
+
+    return res
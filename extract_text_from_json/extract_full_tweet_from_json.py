@@ -1,37 +1,435 @@
+import os
 import sys
-import unicodecsv as csv
+import time
+import glob
+import contextlib
+import argparse
+import itertools
+import collections
+import multiprocessing
+import csv
 import ujson as json
-import gzip
-import tweetURLData 
+import tweetData
+import tweetURLData
+import tweetIdSet
+import whitelistMatcher
+import nbScorer
+import columnarWriter
+import pipelineStats
+import runCheckpoint
+import tweetIO
 import datetime
 
 
 # These settings create a tab-separated file with at least one line per tweet, and additional lines if it contains more than one URL.
-# With these defaults, output contains every tweet and every URL expansion. 
+# With these defaults, output contains every tweet and every URL expansion.
 # See arguments to tweetURLData.extract_urls_from_tweet() for ways to specify the output.
+# (Command-line options such as --whitelist add to these.)
+EXTRACT_ARGS = {'include_non_url_tweets': True, 'show_internal_twitter': True}
 
+# example syntax using a date filter
+#EXTRACT_ARGS = {'earliest_date': datetime.date(2016, 5, 1), 'latest_date': datetime.date(2016, 11, 30),
+#                'include_non_url_tweets': True, 'show_internal_twitter': True}
 
-if len(sys.argv) < 3:
-        print "Usage: extract_full_tweet_from_json.py <inFile.json.gz> <outFile.tsv.gz>"
-        sys.exit(1)
+# only tweets with URLs (the others are skipped without being parsed)
+#EXTRACT_ARGS = {'show_internal_twitter': True}
 
-input_path = sys.argv[1]
-output_path = sys.argv[2]
+# Lines of input handed to a worker at a time (when running with --workers > 1)
+DEFAULT_CHUNK_SIZE = 1000
+# Retweeted statuses remembered (per process) by the tweetURLData.RetweetCache
+DEFAULT_RETWEET_CACHE_SIZE = 10000
+# Seconds between checkpoints when resuming a run that didn't say (see --checkpoint-interval)
+DEFAULT_CHECKPOINT_INTERVAL = 300
 
 
-with gzip.open(input_path, 'r') as fin, gzip.open(output_path, 'wb') as fout:
-    wrtr = csv.DictWriter(fout, tweetURLData.URL_FIELDS,
-                          delimiter='\t', quotechar="'")
-    wrtr.writeheader()
+def main():
+    parser = argparse.ArgumentParser(description="Extract tweet and URL fields from JSON tweets into a tab-separated file.")
+    parser.add_argument('inputs', nargs='+', metavar='inFile.json.gz',
+                        help="one or more JSON files (globs such as 'dir/*.json.gz' are expanded); read in the order given. "
+                             "Gzipped, blockgzip, zstd or uncompressed, recognized by their first bytes")
+    parser.add_argument('output', metavar='outFile.tsv.gz')
+    parser.add_argument('--output-format', choices=['tsv', 'parquet'],
+                        help="compressed TSV, or Parquet with typed columns (needs pyarrow). "
+                             "Default: parquet if the output file name ends in .parquet, else tsv")
+    parser.add_argument('--output-codec', choices=sorted(tweetIO.OUTPUT_CODECS),
+                        help="compression for TSV output: gzip; blockgzip (gzip in independent blocks of whole lines, "
+                             "compressed in parallel, which later runs can split among --workers); zstd (needs "
+                             "zstandard); or plain. Default: zstd if the output file name ends in .zst, else gzip")
+    parser.add_argument('--io-threads', type=int, default=tweetIO.DEFAULT_THREADS,
+                        help="threads for compressing blockgzip or zstd output and decompressing blockgzip input "
+                             "(default %(default)s)")
+    parser.add_argument('--row-group-size', type=int, default=columnarWriter.DEFAULT_ROW_GROUP_SIZE,
+                        help="rows per row group, for Parquet output (default %(default)s)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes to run extraction in (default 1: no process pool)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="lines of input per unit of work sent to a worker (default %(default)s)")
+    parser.add_argument('--unordered', action='store_true',
+                        help="with --workers, write chunks as they finish instead of in input order")
+    parser.add_argument('--per-tweet', action='store_true',
+                        help="write one line per tweet (fields tweetURLData.TWEET_FIELDS, with t.co links expanded in "
+                             "complete_raw_text) instead of one line per URL")
+    parser.add_argument('--whitelist', metavar='whitelist.txt',
+                        help="check each tweet against these terms (e.g. ../keyword_data/whitelist.politics3.txt) "
+                             "and add columns " + ", ".join(tweetURLData.WHITELIST_FIELDS))
+    parser.add_argument('--nb-model', metavar='model-nb-model.tsv',
+                        help="with --whitelist, score each tweet with this naive Bayes model (exported from R by "
+                             "exportNBModel() in ../filter_tweets/classifyTweets.R) and add columns " +
+                             ", ".join(nbScorer.SCORE_FIELDS))
+    parser.add_argument('--retweet-cache', type=int, default=DEFAULT_RETWEET_CACHE_SIZE, metavar='N',
+                        help="remember what was extracted from the N most recently retweeted statuses, so further "
+                             "retweets of them are cheap (default %(default)s per process; 0 turns it off). "
+                             "Hit rates go in --stats-file")
+    parser.add_argument('--dedup-ids', metavar='seen_ids.bin',
+                        help="skip tweets whose IDs are in this file (IDs seen in earlier runs) or already seen in this run; "
+                             "the file is created or updated with all IDs seen once the output is complete")
+    parser.add_argument('--checkpoint-interval', type=float, default=0, metavar='SECONDS',
+                        help="every this often, record in outFile.checkpoint how far the input has been read and the "
+                             "output written, so that an interrupted run can be continued with --resume (TSV output only)")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue the interrupted run that wrote outFile, from its last checkpoint (reads the same "
+                             "inputs it was given, and keeps checkpointing)")
+    parser.add_argument('--skip-done', metavar='done_files.txt',
+                        help="leave out inputs listed in this file, and once the output is complete, add this run's "
+                             "inputs to it. E.g. run hourly on 'dir/*.json.gz' to process only new files")
+    parser.add_argument('--stats-file', metavar='stats.json',
+                        help="write time spent per stage and counts (tweets, retweets, URLs by link_type, ...) "
+                             "to this file at the end, as JSON")
+    parser.add_argument('--progress', type=float, default=0, metavar='SECONDS',
+                        help="print a progress line with the same stats to stderr this often")
+    args = parser.parse_args()
 
-    for line in fin:
-        tweet = json.loads(line.decode("utf8"))
-        map(wrtr.writerow, tweetURLData.extract_urls_from_tweet(tweet, include_non_url_tweets = True, show_internal_twitter = True))
+    input_paths = expand_input_paths(args.inputs)
 
-        # example syntax using a date filter
-        #row_data = tweetURLData.extract_urls_from_tweet(tweet, earliest_date = datetime.date(2016, 5, 1), latest_date = datetime.date(2016, 11, 30),
-        #                                                        include_non_url_tweets = True, show_internal_twitter=True)
-        #if len(row_data) != 0:
-        #    map(wrtr.writerow, row_data)
+    extract_args = dict(EXTRACT_ARGS)
+    if args.per_tweet:
+        extract_func = tweetURLData.extract_tweet_row
+        extract_args.pop('include_non_url_tweets', None)   # always one line per tweet
+        fields = list(tweetURLData.TWEET_FIELDS)
+    else:
+        extract_func = tweetURLData.extract_urls_from_tweet
+        fields = list(tweetURLData.URL_FIELDS)
+    if args.whitelist:
+        extract_args['whitelist_matcher'] = whitelistMatcher.WhitelistMatcher(whitelistMatcher.load_whitelist(args.whitelist))
+        fields += tweetURLData.WHITELIST_FIELDS
+    nb_scorer = None
+    if args.nb_model:
+        if not args.whitelist:
+            parser.error("--nb-model needs --whitelist (the model was trained on text with the whitelist terms removed)")
+        nb_scorer = nbScorer.NBScorer(args.nb_model)
+        fields += nbScorer.SCORE_FIELDS
 
+    output_format = args.output_format or ('parquet' if args.output.endswith('.parquet') else 'tsv')
+    if output_format == 'parquet':
+        extract_args['escape_text'] = False   # no need to mangle text to fit it in a TSV
+        if args.output_codec:
+            parser.error("--output-codec is for TSV output (Parquet output is compressed with snappy)")
+    output_codec = args.output_codec or tweetIO.codec_for_path(args.output)
 
+    checkpoint_path = args.output + '.checkpoint'
+    checkpoint_interval = args.checkpoint_interval or (DEFAULT_CHECKPOINT_INTERVAL if args.resume else 0)
+    if checkpoint_interval and (output_format == 'parquet' or args.unordered):
+        parser.error("--checkpoint-interval and --resume need TSV output written in input order (not parquet or --unordered)")
+    checkpoint = None
+    if args.resume:
+        checkpoint = runCheckpoint.load_checkpoint(checkpoint_path)
+        if checkpoint['fields'] != fields:
+            parser.error("the interrupted run wrote different columns (check --per-tweet and --whitelist)")
+        if args.output_codec and args.output_codec != checkpoint.get('output_codec', 'gzip'):
+            parser.error("the interrupted run wrote " + checkpoint.get('output_codec', 'gzip') + " output")
+        output_codec = checkpoint.get('output_codec', 'gzip')
+        input_paths = checkpoint['inputs']
+    elif args.skip_done:
+        done_paths = runCheckpoint.load_ledger(args.skip_done)
+        input_paths = [path for path in input_paths if os.path.abspath(path) not in done_paths]
+        if not input_paths:
+            sys.stderr.write("No new input files\n")
+            return
+
+    stats = None
+    if args.stats_file or args.progress:
+        stats = pipelineStats.PipelineStats(progress_interval=args.progress)
+
+    seen_ids = tweetIdSet.TweetIdSet(args.dedup_ids) if args.dedup_ids else None
+
+    with open_writer(args.output, fields, output_format, args.row_group_size, output_codec, args.io_threads,
+                     resume_offset=checkpoint['output_bytes'] if checkpoint else None) as wrtr:
+        checkpointer = None
+        positions = None
+        if checkpoint_interval:
+            checkpointer = runCheckpoint.Checkpointer(checkpoint_path, checkpoint_interval, wrtr.fout,
+                                                      {'inputs': input_paths, 'fields': fields,
+                                                       'output_codec': output_codec})
+            positions = collections.deque()
+        chunks = read_chunks(input_paths, args.chunk_size, stats=stats, seen_ids=seen_ids, positions=positions,
+                             start=(checkpoint['file_index'], checkpoint['lines_done']) if checkpoint else None,
+                             io_threads=args.io_threads, split_blocks=args.workers > 1)
+        if args.workers <= 1:
+            init_worker(extract_func, extract_args, stats is not None, args.retweet_cache, nb_scorer)
+            for rows, chunk_stats in itertools.imap(extract_chunk, chunks):
+                write_rows(wrtr, rows, stats, chunk_stats)
+                if checkpointer is not None:
+                    checkpointer.chunk_written(positions.popleft())
+        else:
+            pool = multiprocessing.Pool(args.workers, initializer=init_worker,
+                                        initargs=(extract_func, extract_args, stats is not None, args.retweet_cache,
+                                                  nb_scorer))
+            try:
+                pool_map = pool.imap_unordered if args.unordered else pool.imap
+                for rows, chunk_stats in pool_map(extract_chunk, chunks):
+                    write_rows(wrtr, rows, stats, chunk_stats)
+                    if checkpointer is not None:
+                        checkpointer.chunk_written(positions.popleft())
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+    if seen_ids is not None:
+        seen_ids.save()
+    if args.skip_done:
+        runCheckpoint.add_to_ledger(args.skip_done, input_paths)
+    if checkpointer is not None:
+        checkpointer.finish()
+    if stats is not None:
+        if args.progress:
+            stats.report()
+        if args.stats_file:
+            stats.write(args.stats_file)
+
+
+def write_rows(wrtr, rows, stats, chunk_stats):
+    if stats is None:
+        wrtr.writerows(rows)
+        return
+    start = time.time()
+    wrtr.writerows(rows)
+    stats.add_time('write', time.time() - start)
+    stats.count('rows', len(rows))
+    stats.merge(chunk_stats)
+    stats.maybe_report()
+
+
+# Yields an object with writerows() (taking rows as tuples in the order of fields), for the chosen output format;
+# closes the file afterwards.
+# A TSV is written with the tweetIO writer for codec (as wrtr.fout), whose end_member() marks each checkpoint.
+# resume_offset: continue such a file from this byte offset (where the last checkpoint ended).
+@contextlib.contextmanager
+def open_writer(output_path, fields, output_format, row_group_size, codec='gzip', io_threads=tweetIO.DEFAULT_THREADS,
+                resume_offset=None):
+    if output_format == 'parquet':
+        wrtr = columnarWriter.ParquetRowWriter(output_path, fields, row_group_size=row_group_size)
+        try:
+            yield wrtr
+        finally:
+            wrtr.close()
+    else:
+        fout = tweetIO.open_output(output_path, codec, threads=io_threads, resume_offset=resume_offset)
+        try:
+            wrtr = TSVWriter(fout)
+            if resume_offset is None:
+                wrtr.writerow(fields)
+            yield wrtr
+        finally:
+            fout.close()
+
+
+# csv.writer for rows of unicode (written as utf8) and byte strings. (Does what unicodecsv.writer does for these,
+# without its per-value type checks.)
+class TSVWriter(object):
+
+    def __init__(self, fout):
+        self.fout = fout
+        self.wrtr = csv.writer(fout, delimiter='\t', quotechar="'")
+
+    def writerow(self, row):
+        self.wrtr.writerow([v.encode('utf8') if type(v) is unicode else v for v in row])
+
+    def writerows(self, rows):
+        self.wrtr.writerows([[v.encode('utf8') if type(v) is unicode else v for v in row] for row in rows])
+
+
+# Globs are expanded here (sorted), so a pattern can be quoted on the command line to get around argument length limits.
+def expand_input_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                sys.exit("No input files match " + pattern)
+            paths.extend(matches)
+        else:
+            paths.append(pattern)
+    return paths
+
+
+# Yields lists of (up to chunk_size) raw lines, continuing across input files.
+# With stats, the time spent reading and decompressing (and checking IDs) is recorded as stage 'read'.
+# seen_ids: a tweetIdSet.TweetIdSet. Lines with IDs in it are dropped here, before going to any worker;
+#   the others' IDs are added to it.
+# positions: a deque to which, for each chunk yielded, is appended where it ends: (index into input_paths, lines read
+#   from that file). start: such a position to continue from; lines before it are skipped (but with seen_ids, their
+#   IDs are still added, so duplicates are dropped the same as in an uninterrupted run).
+# io_threads: for tweetIO (decompressing blockgzip input).
+# split_blocks: for blockgzip inputs (without seen_ids), yield tweetIO.BlockRanges of about chunk_size lines instead of
+#   lines, leaving reading and decompressing them to extract_chunk (in the workers). Only block headers are read here.
+def read_chunks(input_paths, chunk_size, stats=None, seen_ids=None, positions=None, start=None,
+                io_threads=tweetIO.DEFAULT_THREADS, split_blocks=False):
+    chunk = []
+    chunk_end = None
+    start_time = time.time()
+    for file_index, input_path in enumerate(input_paths):
+        skip_lines = 0
+        if start is not None and file_index <= start[0]:
+            if file_index < start[0] and seen_ids is None:
+                continue
+            skip_lines = start[1] if file_index == start[0] else None   # (None: the whole file)
+
+        if split_blocks and seen_ids is None and tweetIO.detect_codec(input_path) == 'blockgzip':
+            if chunk:
+                if stats is not None:
+                    stats.add_time('read', time.time() - start_time)
+                if positions is not None:
+                    positions.append(chunk_end)
+                yield chunk
+                chunk = []
+            start_time = time.time()
+            lines_done = 0
+            for block_range, n_lines in tweetIO.block_ranges(input_path, chunk_size):
+                lines_done += n_lines
+                if lines_done <= skip_lines:
+                    continue
+                if lines_done - n_lines < skip_lines:
+                    block_range = block_range._replace(skip_lines=skip_lines - (lines_done - n_lines))
+                if stats is not None:
+                    stats.add_time('read', time.time() - start_time)
+                if positions is not None:
+                    positions.append((file_index, lines_done))
+                yield block_range
+                start_time = time.time()
+            continue
+
+        line_number = 0
+        with tweetIO.open_lines(input_path, io_threads) as fin:
+            for line_number, line in enumerate(fin, 1):
+                if skip_lines is None or line_number <= skip_lines:
+                    if seen_ids is not None:
+                        tweet_id = line_tweet_id(line)
+                        if tweet_id is not None:
+                            seen_ids.add(tweet_id)
+                    continue
+                if seen_ids is not None:
+                    tweet_id = line_tweet_id(line)
+                    if tweet_id is not None and not seen_ids.add(tweet_id):
+                        if stats is not None:
+                            stats.count('tweets_duplicate')
+                        continue
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    if stats is not None:
+                        stats.add_time('read', time.time() - start_time)
+                    if positions is not None:
+                        positions.append((file_index, line_number))
+                    yield chunk
+                    chunk = []
+                    start_time = time.time()
+        chunk_end = (file_index, line_number)
+    if chunk:
+        if stats is not None:
+            stats.add_time('read', time.time() - start_time)
+        if positions is not None:
+            positions.append(chunk_end)
+        yield chunk
+
+
+# Tweet ID of a raw JSON line: read off the start of the line if possible, else by parsing it.
+# None for lines without one (such as deletion notices), which are never treated as duplicates.
+def line_tweet_id(line):
+    tweet_id = tweetData.peek_tweet_id(line)
+    if tweet_id is None:
+        tweet_id = json.loads(line).get('id_str')
+    return tweet_id
+
+
+# Function that turns a tweet into rows (extract_urls_from_tweet or extract_tweet_row) and its arguments,
+# set in each process before it handles any chunks; the process's own stats, if collecting them; and the
+# nbScorer.NBScorer, if scoring
+worker_extract_func = None
+worker_extract_args = None
+worker_stats = None
+worker_nb_scorer = None
+
+
+def init_worker(extract_func, extract_args, collect_stats=False, retweet_cache_size=0, nb_scorer=None):
+    global worker_extract_func, worker_extract_args, worker_stats, worker_nb_scorer
+    worker_extract_func = extract_func
+    worker_extract_args = dict(extract_args)
+    worker_nb_scorer = nb_scorer
+    if collect_stats:
+        worker_stats = pipelineStats.PipelineStats()
+        worker_extract_args['stats'] = worker_stats
+    if retweet_cache_size > 0:
+        worker_extract_args['retweet_cache'] = tweetURLData.RetweetCache(retweet_cache_size)
+
+
+# Unit of work for one process: raw JSON lines (or a tweetIO.BlockRange of them, read here) in, output rows out (in
+# the same order). Returns (rows, stats for this chunk or None).
+# Lines that can't give any rows are skipped before being parsed: with a date range, lines whose created_at comes first
+# and is out of range; and, when only tweets with URLs are wanted (include_non_url_tweets off), lines without any.
+# (Counters such as retweets then cover only the tweets that were parsed.)
+# ujson decodes the utf8 itself.
+# With an nb_scorer, the chunk's tweets are scored together at the end.
+def extract_chunk(lines):
+    if type(lines) is tweetIO.BlockRange:
+        if worker_stats is not None:
+            worker_stats.mark()
+        lines = tweetIO.read_block_range(lines)
+        if worker_stats is not None:
+            worker_stats.lap('read')
+
+    score_batch = None
+    if worker_nb_scorer is not None:
+        score_batch = worker_extract_args['score_batch'] = worker_nb_scorer.new_batch()
+
+    earliest_date = worker_extract_args.get('earliest_date')
+    latest_date = worker_extract_args.get('latest_date')
+    if earliest_date is not None or latest_date is not None:
+        n_lines = len(lines)
+        lines = [line for line in lines if tweetURLData.line_in_date_range(line, earliest_date, latest_date)]
+        if worker_stats is not None:
+            worker_stats.count('tweets', n_lines - len(lines))
+            worker_stats.count('tweets_date_filtered', n_lines - len(lines))
+    if worker_extract_func is tweetURLData.extract_urls_from_tweet and \
+            not worker_extract_args.get('include_non_url_tweets'):
+        n_lines = len(lines)
+        lines = [line for line in lines if tweetURLData.line_has_urls(line)]
+        if worker_stats is not None:
+            worker_stats.count('tweets', n_lines - len(lines))
+            worker_stats.count('tweets_without_urls', n_lines - len(lines))
+
+    rows = []
+    if worker_stats is None:
+        for line in lines:
+            tweet = json.loads(line)
+            rows.extend(worker_extract_func(tweet, **worker_extract_args))
+        if score_batch is not None:
+            rows = score_batch.finish(rows)
+        return rows, None
+
+    for line in lines:
+        worker_stats.mark()
+        tweet = json.loads(line)
+        worker_stats.lap('json')
+        rows.extend(worker_extract_func(tweet, **worker_extract_args))
+    worker_stats.count('tweets', len(lines))
+    if score_batch is not None:
+        worker_stats.mark()
+        rows = score_batch.finish(rows)
+        worker_stats.lap('score')
+    return rows, worker_stats.take()
+
+
+if __name__ == "__main__":
+    main()
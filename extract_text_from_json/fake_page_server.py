@@ -0,0 +1,180 @@
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import ujson as json
+
+
+# Local stand-in for the web pages expandURLs fetches, for trying out and testing fetch_html_batch and
+# expand_url_batch without going out to the internet. Serves --hosts made-up hosts, host i on port --port + i
+# (expandURLs tells hosts apart by host:port, so http://127.0.0.1:8100/ and http://127.0.0.1:8101/ count as two).
+# Every host has the same paths:
+#   /page/<anything>            a small HTML page with a title, description and canonical link
+#   /file/<anything>            a non-HTML file
+#   /redirect/<n>/<path>        redirects (302) n times, then to /<path> on the same host, e.g. /redirect/2/page/a
+#   /redirect-host/<i>/<path>   redirects to /<path> on host i
+#   /status/<code>              answers with that HTTP status
+#   /stats                      (JSON) per host: requests answered (and how many were GETs and HEADs), and the most
+#                               that were in progress at once
+# --latency delays every response and --error-rate answers some requests with a 503; --host-latency and
+# --host-error-rate set them for one host (e.g. --host-latency 2=3.0 makes host 2 slow).
+#
+# Usage: python fake_page_server.py [--port 8100] [--hosts 4] [options]
+# then call the batch functions on URLs such as http://127.0.0.1:8100/redirect/1/page/a (see README.md).
+# start_hosts() runs the same hosts inside another program (as check_batch_fetches.py does).
+
+PAGE = ('<html><head><title>Page %(path)s on host %(host)d</title>'
+        '<meta name="description" content="Made-up page %(path)s">'
+        '<link rel="canonical" href="http://127.0.0.1:%(port)d/page/%(path)s">'
+        '</head><body>%(filler)s</body></html>')
+FILLER = '<p>' + 'Lorem ipsum dolor sit amet. ' * 400 + '</p>'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve made-up web pages on several local ports, as separate hosts.")
+    parser.add_argument('--port', type=int, default=8100, help="port of host 0 (default %(default)s)")
+    parser.add_argument('--hosts', type=int, default=4, help="number of hosts (default %(default)s)")
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to each request")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests that get a 503")
+    parser.add_argument('--host-latency', action='append', default=[], metavar='HOST=SECONDS',
+                        help="latency for one host (may be repeated)")
+    parser.add_argument('--host-error-rate', action='append', default=[], metavar='HOST=RATE',
+                        help="error rate for one host (may be repeated)")
+    args = parser.parse_args()
+
+    latencies = [args.latency] * args.hosts
+    error_rates = [args.error_rate] * args.hosts
+    for values, settings in ((latencies, args.host_latency), (error_rates, args.host_error_rate)):
+        for setting in settings:
+            host, value = setting.split('=')
+            values[int(host)] = float(value)
+
+    start_hosts(args.port, latencies, error_rates)
+    sys.stderr.write("Serving %d hosts on ports %d-%d\n" % (args.hosts, args.port, args.port + args.hosts - 1))
+    while True:
+        time.sleep(1)
+
+
+def start_hosts(port, latencies, error_rates):
+    """ Starts serving host i on port + i, with latencies[i] and error_rates[i], in background threads.
+        Returns their HostStats. """
+    stats = HostStats(len(latencies))
+    for host in range(len(latencies)):
+        server = PageServer(('127.0.0.1', port + host), PageHandler)
+        server.host = host
+        server.base_port = port
+        server.latency = latencies[host]
+        server.error_rate = error_rates[host]
+        server.stats = stats
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return stats
+
+
+class HostStats(object):
+    """ Requests answered by each host (in all, and by method), and the most it had in progress at once. """
+
+    def __init__(self, n_hosts):
+        self.requests = [0] * n_hosts
+        self.by_method = [{'GET': 0, 'HEAD': 0} for _ in range(n_hosts)]
+        self.in_progress = [0] * n_hosts
+        self.max_in_progress = [0] * n_hosts
+        self.lock = threading.Lock()
+
+    def start(self, host, method):
+        with self.lock:
+            self.requests[host] += 1
+            self.by_method[host][method] += 1
+            self.in_progress[host] += 1
+            self.max_in_progress[host] = max(self.max_in_progress[host], self.in_progress[host])
+
+    def finish(self, host):
+        with self.lock:
+            self.in_progress[host] -= 1
+
+    def as_dict(self):
+        with self.lock:
+            return dict((host, {'requests': n, 'gets': by_method['GET'], 'heads': by_method['HEAD'],
+                                'max_in_progress': most})
+                        for host, (n, by_method, most) in enumerate(zip(self.requests, self.by_method,
+                                                                        self.max_in_progress)))
+
+
+class PageServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # fetch_html hangs up once it has read a page's <head>, so dropped connections are normal
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class PageHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.answer(send_body=True)
+
+    def do_HEAD(self):
+        self.answer(send_body=False)
+
+    def answer(self, send_body):
+        server = self.server
+        parts = self.path.split('?', 1)[0].strip('/').split('/', 2)
+        if parts[0] == 'stats':
+            return self.respond(200, 'application/json', json.dumps(server.stats.as_dict()), send_body)
+
+        server.stats.start(server.host, self.command)
+        try:
+            time.sleep(server.latency)
+            if random.random() < server.error_rate:
+                return self.respond(503, 'text/plain', 'Service unavailable', send_body)
+            self.answer_path(parts, send_body)
+        finally:
+            server.stats.finish(server.host)
+
+    def answer_path(self, parts, send_body):
+        server = self.server
+        kind = parts[0]
+        rest = parts[1:] + [''] * (2 - len(parts[1:]))
+        if kind == 'page':
+            page = PAGE % {'path': '/'.join(parts[1:]), 'host': server.host,
+                           'port': server.base_port + server.host, 'filler': FILLER}
+            self.respond(200, 'text/html; charset=utf-8', page, send_body)
+        elif kind == 'file':
+            self.respond(200, 'application/octet-stream', '\0' * 10000, send_body)
+        elif kind == 'redirect' and rest[0].isdigit():
+            n = int(rest[0])
+            location = '/redirect/%d/%s' % (n - 1, rest[1]) if n > 1 else '/' + rest[1]
+            self.redirect(location, send_body)
+        elif kind == 'redirect-host' and rest[0].isdigit():
+            self.redirect('http://127.0.0.1:%d/%s' % (server.base_port + int(rest[0]), rest[1]), send_body)
+        elif kind == 'status' and rest[0].isdigit():
+            self.respond(int(rest[0]), 'text/plain', 'Status ' + rest[0], send_body)
+        else:
+            self.respond(404, 'text/plain', 'Not found', send_body)
+
+    def redirect(self, location, send_body):
+        self.respond(302, 'text/plain', 'Moved', send_body, {'Location': location})
+
+    def respond(self, status, content_type, body, send_body, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import os
+import time
+import urlparse
+import threading
+import itertools
+import ujson as json
+from collections import OrderedDict
+
+# Decides, per URL, how much network work expandURLs should do for it, based on what's known about its domain:
+#   SKIP    - don't touch the network (media CDNs; domains whose fetches nearly always fail)
+#   RESOLVE - HEAD only: follow redirects to get landing_url, but don't download the page (hosts that don't serve html)
+#   FETCH   - the usual: HEAD, then GET the page's <head> and parse it
+# Redirectors (bit.ly and the like) are resolved first, and then the landing URL is planned on its own domain's merits.
+#
+# What's known comes from a config file (seed rules by domain; see fetch_planner_domains.json) and from a profile
+# of each host that's updated with every fetch: number of fetches, errors, html vs. other content, redirects to another
+# host, and a moving average of latency. Learned rules kick in once a host has min_fetches fetches; config rules
+# always win. Profiles can be saved and loaded, so they carry over between runs.
+#
+# Used through expandURLs' batch functions (expand_url_batch(urls, planner=FetchPlanner(...))), which then
+#   -fetch each distinct URL once per batch,
+#   -order the work so slow hosts don't block fast ones: URLs on hosts expected to answer within slow_seconds go
+#    first, round-robin across hosts, then those on slow hosts (also round-robin). Otherwise a run of URLs on one slow
+#    host ties up all the threads, each waiting its turn at that host (max_per_host), while fast hosts wait,
+#   -still return results in input order. A skipped URL's result is {'err': SKIPPED_ERR}.
+
+SKIP = 'skip'
+RESOLVE = 'resolve'
+FETCH = 'fetch'
+
+SKIPPED_ERR = 'Skipped by fetch planner'
+
+# Rules for learned profiles (each can be overridden in the config's "defaults")
+DEFAULT_RULES = {
+    'min_fetches': 5,          # fetches of a host before its profile is used
+    'max_error_rate': 0.8,     # skip hosts with at least this share of errors...
+    'reprobe_every': 50,       # ...except for every Nth URL, in case they've recovered
+    'min_html_rate': 0.1,      # only resolve hosts with less than this share of html among successful fetches
+    'redirector_rate': 0.8,    # treat hosts that send at least this share of fetches to another host as redirectors
+    'latency_weight': 0.2,     # weight of the newest fetch in the moving average of latency
+    'slow_seconds': 2.0,       # hosts whose average latency is above this are fetched after all the others
+}
+# expected latency (seconds) of a host without a profile, for ordering
+UNKNOWN_LATENCY = 1.0
+
+
+class FetchPlanner(object):
+
+    def __init__(self, config_path=None, profiles_path=None):
+        """ config_path: JSON file of {"defaults": {rule: value}, "domains": {domain: {"action": "skip"/"resolve"/
+               "fetch", "redirector": true/false}}}. A domain matches itself and its subdomains.
+            profiles_path: file to load learned host profiles from, if it exists (and where save() writes). """
+        self.rules = dict(DEFAULT_RULES)
+        self.domain_config = {}
+        if config_path is not None:
+            with open(config_path, 'r') as fin:
+                config = json.load(fin)
+            self.rules.update(config.get('defaults', {}))
+            self.domain_config = dict((domain.lower(), rule) for domain, rule in config.get('domains', {}).iteritems())
+        self.profiles_path = profiles_path
+        self.profiles = {}
+        if profiles_path is not None and os.path.exists(profiles_path):
+            with open(profiles_path, 'r') as fin:
+                self.profiles = json.load(fin)
+        self.lock = threading.Lock()
+        self.counts = {SKIP: 0, RESOLVE: 0, FETCH: 0, 'landing_fetches': 0}
+
+    def configured(self, host):
+        """ The config's rule for host or the closest of its parent domains, or {}. """
+        parts = host.split('.')
+        for i in xrange(len(parts) - 1):
+            rule = self.domain_config.get('.'.join(parts[i:]))
+            if rule is not None:
+                return rule
+        return {}
+
+    def is_redirector(self, host):
+        rule = self.configured(host)
+        if 'redirector' in rule:
+            return rule['redirector']
+        profile = self.usable_profile(host)
+        return profile is not None and profile['redirects'] >= self.rules['redirector_rate'] * profile['fetches']
+
+    def usable_profile(self, host):
+        profile = self.profiles.get(host)
+        if profile is None or profile['fetches'] < self.rules['min_fetches']:
+            return None
+        return profile
+
+    def plan(self, url):
+        """ SKIP, RESOLVE or FETCH, counted in stats(). """
+        action = self.decide(url)
+        with self.lock:
+            self.counts[action] += 1
+        return action
+
+    def decide(self, url):
+        """ What plan() would say, without counting it. """
+        host = url_host(url)
+        action = self.configured(host).get('action')
+        if action is None:
+            action = self.learned_action(host)
+        return action
+
+    def learned_action(self, host):
+        if self.is_redirector(host):
+            return RESOLVE
+        profile = self.usable_profile(host)
+        if profile is None:
+            return FETCH
+        if profile['errors'] >= self.rules['max_error_rate'] * profile['fetches']:
+            with self.lock:
+                profile['skipped'] = profile.get('skipped', 0) + 1
+                reprobe = profile['skipped'] % self.rules['reprobe_every'] == 0
+            return FETCH if reprobe else SKIP
+        n_ok = profile['fetches'] - profile['errors']
+        if n_ok > 0 and profile['html'] < self.rules['min_html_rate'] * n_ok:
+            return RESOLVE
+        return FETCH
+
+    def observe(self, url, res, seconds):
+        """ Updates the profile of url's host with a result of fetch_html or expand_url. """
+        host = url_host(url)
+        landing_host = url_host(res['landing_url']) if 'landing_url' in res else host
+        weight = self.rules['latency_weight']
+        with self.lock:
+            profile = self.profiles.get(host)
+            if profile is None:
+                profile = self.profiles[host] = {'fetches': 0, 'errors': 0, 'html': 0, 'redirects': 0,
+                                                 'latency': seconds}
+            profile['fetches'] += 1
+            profile['errors'] += int('err' in res)
+            profile['html'] += int(res.get('is_html') == 1)
+            profile['redirects'] += int(landing_host != host)
+            profile['latency'] += weight * (seconds - profile['latency'])
+
+    def expected_latency(self, host):
+        profile = self.profiles.get(host)
+        return profile['latency'] if profile is not None else UNKNOWN_LATENCY
+
+    def order(self, urls):
+        """ Reorders (distinct) urls: those on fast hosts, then those on slow ones, each round-robin across hosts
+            with the expected-fastest hosts first in each round. """
+        by_host = OrderedDict()
+        for url in urls:
+            by_host.setdefault(url_host(url), []).append(url)
+        hosts = sorted(by_host, key=self.expected_latency)
+        fast_hosts = [host for host in hosts if self.expected_latency(host) <= self.rules['slow_seconds']]
+        slow_hosts = hosts[len(fast_hosts):]
+        return round_robin([by_host[host] for host in fast_hosts]) + round_robin([by_host[host] for host in slow_hosts])
+
+    def run_batch(self, fetch, urls, run, fast_only=False):
+        """ For expandURLs' batch functions: plans urls, runs the ones not skipped through
+            run(planned_fetch, ordered_urls, is_fast_only) (which returns results in the order given), and yields
+            results in the order of urls. fetch(url, session, fast_only) does one HEAD (fast_only) or full fetch.
+            is_fast_only(url) says whether url is only to be resolved (so that a cached full fetch will do for it,
+            but not the other way round).
+            fast_only: the caller only wants redirects resolved (fastOnlyExpandURL), whatever the plan; then no url
+               is fetched fully, not even where a redirector led. """
+        urls = list(urls)
+        plans = OrderedDict()
+        for url in urls:
+            if url not in plans:
+                plans[url] = self.plan(url)
+        results = dict((url, {'err': SKIPPED_ERR}) for url, action in plans.iteritems() if action == SKIP)
+        ordered = self.order([url for url, action in plans.iteritems() if action != SKIP])
+
+        def is_fast_only(url):
+            return fast_only or plans[url] == RESOLVE
+
+        def planned_fetch(url, session):
+            res = self.timed_fetch(fetch, url, session, is_fast_only(url))
+            # for redirectors, decide again for where they led (counted as a landing fetch, not as another plan)
+            if not fast_only and plans[url] == RESOLVE and 'err' not in res and 'landing_url' in res and \
+               self.is_redirector(url_host(url)) and self.decide(res['landing_url']) == FETCH:
+                with self.lock:
+                    self.counts['landing_fetches'] += 1
+                res = self.timed_fetch(fetch, res['landing_url'], session, False)
+            return res
+
+        next_index = 0
+        for url, res in itertools.izip(ordered, run(planned_fetch, ordered, is_fast_only)):
+            results[url] = res
+            while next_index < len(urls) and urls[next_index] in results:
+                yield results[urls[next_index]]
+                next_index += 1
+        for url in urls[next_index:]:
+            yield results[url]
+
+    def timed_fetch(self, fetch, url, session, fast_only):
+        start = time.time()
+        res = fetch(url, session, fast_only)
+        self.observe(url, res, time.time() - start)
+        return res
+
+    def stats(self):
+        """ Number of URLs planned for each action (and fetched after resolving a redirector), and hosts profiled. """
+        with self.lock:
+            counts = dict(self.counts)
+        counts['hosts'] = len(self.profiles)
+        return counts
+
+    def save(self, path=None):
+        """ Writes the host profiles to path (default: the one loaded from). """
+        path = path or self.profiles_path
+        with self.lock:
+            data = json.dumps(self.profiles)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            fout.write(data)
+        os.rename(tmp_path, path)
+
+
+def round_robin(lists):
+    return [item for round_items in itertools.izip_longest(*lists) for item in round_items if item is not None]
+
+
+def url_host(url):
+    return urlparse.urlsplit(url).hostname or ''
@@ -0,0 +1,215 @@
+import re
+import itertools
+import numpy as np
+
+# Python scoring for the naive Bayes classifier of filter_tweets/classifyTweets.R (binaryNBModel), so tweets can be
+# scored as they're extracted instead of in a daily batch job in R.
+#
+# The model is read from the file written by exportNBModel() in classifyTweets.R (<modelFileOutStem>-nb-model.tsv):
+#   llr_offset<TAB><default_logPred>
+#   term<TAB>llr
+#   <term><TAB><termsToAddWhenX for the term>
+#   ...
+# A tweet's score is llr_offset plus the llr of each distinct vocabulary term it contains (features are binary), passed
+# through the logistic function, as in naiveBayes.predict().
+#
+# Tweets are tokenized as by tokenizeTweet() in textProcessingForClassifier.R, with its defaults (breakCamelCase,
+# removeApostS, keepUSA, doStemming), applied to the text left after taking out the whitelist terms (rest_of_text; see
+# whitelistMatcher.WhitelistMatcher.match_and_remove). Differences from R:
+#  -tokenize_words' ICU word boundaries are approximated by a regex (runs of letters, digits and _, joined across
+#   . : ' between letters and . , ; ' between digits). Ideographic scripts aren't split into words the way ICU does.
+#  -Stemming (SnowballC::wordStem's English stemmer) uses PyStemmer, which wraps the same Snowball C library, or else
+#   nltk's EnglishStemmer. One of them must be installed (pip install PyStemmer).
+#  -R gives NaN for scores so high that exp() overflows; here they're 1.
+#
+# Scores are computed a chunk of tweets at a time: the extract functions give a ScoreBatch each tweet's terms as they
+# go, and ScoreBatch.finish() scores them all with one numpy bincount (a sparse matrix-vector product) and adds
+# SCORE_FIELDS to the rows.
+
+SCORE_FIELDS = ['raw_classifier_score', 'classifier_score']
+
+# Patterns from tokenizeTweet. R's perl=T patterns match word characters and spaces in ASCII only (no (*UCP)),
+# so these aren't compiled with re.UNICODE.
+URL_PATTERN = re.compile(r'\bhttps?\:\S+')
+HANDLE_HASH_PATTERN = re.compile(r'(@|#)[\w_]+')
+HANDLE_HASH_PUNCT_PATTERN = re.compile(r'[@#]+')
+CAMEL_CASE_PATTERN = re.compile(r'([A-Z][a-z]+|[A-Z]+|[a-z]+|[0-9]+)')
+USA_PATTERN = re.compile(r'(?<![\w\.])u\.s\.(a\.)?(?!\w)')
+# Stand-in for tokenize_words (stringi's ICU word boundaries, dropping spaces and punctuation)
+WORD_PATTERN = re.compile(u"\\w+(?:(?:(?<=[^\\W\\d_])[.:'\u2019\u00b7](?=[^\\W\\d_])|(?<=\\d)[.,;'\u2019](?=\\d))\\w+)*",
+                          re.UNICODE)
+
+# Stems remembered per NBScorer (cleared when full)
+MAX_STEM_CACHE_SIZE = 1000000
+
+
+def load_nb_model(path):
+    """ Reads a model exported by exportNBModel(). Returns (llr_offset, list of terms, numpy array of their llrs). """
+    with open(path, 'r') as fin:
+        name, llr_offset = fin.readline().rstrip('\r\n').split('\t')
+        if name != 'llr_offset':
+            raise ValueError(path + " doesn't look like a model from exportNBModel() (no llr_offset line)")
+        fin.readline()   # header: term, llr
+        terms = []
+        llrs = []
+        for line in fin:
+            term, llr = line.rstrip('\r\n').split('\t')
+            terms.append(term.decode('utf8'))
+            llrs.append(float(llr))
+    return float(llr_offset), terms, np.array(llrs, dtype=np.float64)
+
+
+def load_stemmer():
+    """ Returns a function that stems one (lowercase) English word, or None if no stemmer is installed. """
+    try:
+        import Stemmer
+        return Stemmer.Stemmer('english').stemWord
+    except ImportError:
+        pass
+    try:
+        from nltk.stem.snowball import EnglishStemmer
+        return EnglishStemmer().stem
+    except ImportError:
+        return None
+
+
+class NBScorer(object):
+
+    def __init__(self, model_path, stem=True, break_camel_case=True, remove_apost_s=True, keep_usa=True):
+        """ stem, break_camel_case, remove_apost_s, keep_usa: tokenizeTweet's doStemming, breakCamelCase, removeApostS
+            and keepUSA, which must be as they were when the model was trained. """
+        self.llr_offset, terms, self.llr = load_nb_model(model_path)
+        self.vocab = dict((term, i) for i, term in enumerate(terms))
+        self.stemmer = None
+        if stem:
+            self.stemmer = load_stemmer()
+            if self.stemmer is None:
+                raise ImportError("Scoring with a model trained on stemmed words needs PyStemmer or nltk "
+                                  "(pip install PyStemmer)")
+        self.stems = {}
+        self.break_camel_case = break_camel_case
+        self.remove_apost_s = remove_apost_s
+        self.keep_usa = keep_usa
+
+    # (the stemmer isn't pickled along with the scorer, e.g. for multiprocessing workers; it's loaded again)
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['stemmer'] = state['stemmer'] is not None
+        state['stems'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stemmer = load_stemmer() if state['stemmer'] else None
+
+    def stem(self, word):
+        stem = self.stems.get(word)
+        if stem is None:
+            if len(self.stems) >= MAX_STEM_CACHE_SIZE:
+                self.stems.clear()
+            stem = self.stems[word] = self.stemmer(word)
+        return stem
+
+    def tokenize(self, text):
+        return tokenize_tweet(text, self.break_camel_case, self.remove_apost_s, self.keep_usa,
+                              self.stem if self.stemmer is not None else None)
+
+    def tweet_terms(self, rest_of_text):
+        """ Vocabulary indices of the distinct terms in the text (a list of ints). """
+        vocab = self.vocab
+        return list(set(vocab[token] for token in self.tokenize(rest_of_text) if token in vocab))
+
+    def score(self, term_lists):
+        """ P(political) for each tweet, given each one's tweet_terms(), as a numpy array. """
+        lengths = np.fromiter((len(terms) for terms in term_lists), dtype=np.int64, count=len(term_lists))
+        term_indices = np.fromiter(itertools.chain.from_iterable(term_lists), dtype=np.int64, count=lengths.sum())
+        tweet_indices = np.repeat(np.arange(len(term_lists)), lengths)
+        llr = np.bincount(tweet_indices, weights=self.llr[term_indices], minlength=len(term_lists)) + self.llr_offset
+        with np.errstate(over='ignore'):
+            return 1.0 / (1.0 + np.exp(-llr))
+
+    def new_batch(self):
+        return ScoreBatch(self)
+
+
+class ScoreBatch(object):
+    """ Collects a chunk's tweets as the extract functions make their rows (add()), then scores them together and
+        adds SCORE_FIELDS to the rows (finish()). """
+
+    def __init__(self, scorer):
+        self.scorer = scorer
+        self.n_rows = []
+        self.term_lists = []
+        self.labels = []
+
+    def add(self, n_rows, terms, classifier_label):
+        """ For one tweet: the number of rows it got, its tweet_terms() and whether it matched the whitelist. """
+        self.n_rows.append(n_rows)
+        self.term_lists.append(terms)
+        self.labels.append(classifier_label)
+
+    def finish(self, rows):
+        """ rows: all the rows made since the batch started, in order. Returns them with raw_classifier_score and
+            classifier_score added (the latter is 1 for tweets that matched the whitelist). """
+        scores = self.scorer.score(self.term_lists)
+        scored_rows = []
+        start = 0
+        for n_rows, score, classifier_label in itertools.izip(self.n_rows, scores.tolist(), self.labels):
+            score_part = (score, 1.0 if classifier_label else score)
+            scored_rows.extend(row + score_part for row in rows[start:start + n_rows])
+            start += n_rows
+        return scored_rows
+
+
+# Python version of tokenizeTweet() (with one tweet at a time): a list of tokens, including each full URL.
+# stem: function to stem each word with, or None.
+def tokenize_tweet(text, break_camel_case=True, remove_apost_s=True, keep_usa=True, stem=None):
+    url_matches = list(URL_PATTERN.finditer(text))
+    lower = text.lower()
+    urls = [lower[m.start():m.end()] for m in url_matches]
+    noturls = u' '.join(split_around(text, url_matches))
+
+    # handles and hashtags, with their pieces split at camel case and numbers (from the original case)
+    handles_hashes_matches = list(HANDLE_HASH_PATTERN.finditer(noturls))
+    handles_hashes = [HANDLE_HASH_PUNCT_PATTERN.sub(u'', m.group()) for m in handles_hashes_matches]
+    handles_hashes_text = u' '.join(handles_hashes)
+    just_words = u' '.join(split_around(noturls.lower(), handles_hashes_matches))
+    if break_camel_case:
+        new_bits = [piece for piece in CAMEL_CASE_PATTERN.findall(handles_hashes_text) if piece not in handles_hashes]
+        handles_hashes_text = (handles_hashes_text + u' ' + u' '.join(new_bits)).lower()
+    else:
+        handles_hashes_text = handles_hashes_text.lower()
+
+    if remove_apost_s:
+        just_words = just_words.replace(u"'s", u" ")
+    just_words = just_words.replace(u"'", u"")
+    if keep_usa:
+        just_words = USA_PATTERN.sub(u'usa', just_words)
+
+    tokens = WORD_PATTERN.findall(u' '.join([just_words, handles_hashes_text, r_list_element_text(urls)]))
+    if stem is not None:
+        tokens = [stem(token) for token in tokens]
+    return tokens + urls
+
+
+# The pieces of text between the matches (like R's regmatches(invert=T)).
+def split_around(text, matches):
+    pieces = []
+    prev = 0
+    for m in matches:
+        pieces.append(text[prev:m.start()])
+        prev = m.end()
+    pieces.append(text[prev:])
+    return pieces
+
+
+# tokenizeTweet pastes each tweet's URLs into its text as a list element, which R turns into text like
+# as.character(list(urls)) does: "character(0)" when there are none, the URL itself when there's one, and
+# c("url1", "url2") for more. The model's vocabulary was learned that way (e.g. "character" and "0" are terms),
+# so the same text is tokenized here.
+def r_list_element_text(urls):
+    if not urls:
+        return u'character(0)'
+    if len(urls) == 1:
+        return urls[0]
+    return u'c(' + u', '.join(u'"' + url.replace(u'\\', u'\\\\').replace(u'"', u'\\"') + u'"' for url in urls) + u')'
@@ -0,0 +1,112 @@
+import sys
+import time
+import threading
+import ujson as json
+from collections import defaultdict
+
+# Opt-in timing and counters for the extraction and URL expansion pipeline.
+# Functions that can be instrumented take stats=None; passing a PipelineStats makes them record
+#   - cumulative seconds per stage (add_time, or mark/lap around consecutive stages)
+#   - event counters (count), e.g. tweets dropped by the date filter, retweets, URLs of each link_type
+#   - for fetch_html, the outcome (ok, HTTP 4xx, ReadTimeout, ConnectionError, ...) and latency of each fetch
+# When stats is None (the default) the only cost is an "is not None" check.
+#
+# Stats from several processes are combined with merge(): each worker collects its own, hands them back with take(),
+# and the main process adds them up (so stage times are summed over processes).
+# Not thread-safe, except add_time and observe_fetch (which fetch_html_batch's threads call).
+
+# upper bounds (seconds) of the latency histogram's buckets; the last bucket is everything slower
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+
+
+class PipelineStats(object):
+
+    def __init__(self, progress_interval=0, progress_out=sys.stderr):
+        """ progress_interval: if > 0, maybe_report() writes a progress line to progress_out at most
+            this often (in seconds). """
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.fetch_latency = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))  # outcome -> histogram
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_mark = self.start_time
+        self.progress_interval = progress_interval
+        self.progress_out = progress_out
+        self.next_report = self.start_time + progress_interval
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.times[stage] += seconds
+
+    def mark(self):
+        self.last_mark = time.time()
+
+    # Charges the time since the last mark() or lap() to stage.
+    def lap(self, stage):
+        now = time.time()
+        self.times[stage] += now - self.last_mark
+        self.last_mark = now
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def observe_fetch(self, outcome, seconds):
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            self.fetch_latency[outcome][bucket] += 1
+
+    def merge(self, other):
+        """ Adds in the stats of other (a PipelineStats, or the dictionary from its take() or to_dict()). """
+        if isinstance(other, PipelineStats):
+            other = other.to_dict()
+        for stage, seconds in other['times'].iteritems():
+            self.times[stage] += seconds
+        for name, n in other['counts'].iteritems():
+            self.counts[name] += n
+        for outcome, histogram in other['fetch_latency'].iteritems():
+            mine = self.fetch_latency[outcome]
+            for i, n in enumerate(histogram):
+                mine[i] += n
+
+    def to_dict(self):
+        return {'elapsed_seconds': time.time() - self.start_time,
+                'times': dict(self.times),
+                'counts': dict(self.counts),
+                'fetch_outcomes': dict((outcome, sum(histogram)) for outcome, histogram in self.fetch_latency.iteritems()),
+                'fetch_latency_buckets': LATENCY_BUCKETS + ['inf'],
+                'fetch_latency': dict(self.fetch_latency)}
+
+    def take(self):
+        """ Returns to_dict() and starts over from zero. """
+        with self.lock:
+            res = self.to_dict()
+            self.times.clear()
+            self.counts.clear()
+            self.fetch_latency.clear()
+        return res
+
+    def maybe_report(self):
+        if self.progress_interval > 0 and time.time() >= self.next_report:
+            self.report()
+            self.next_report = time.time() + self.progress_interval
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        parts = []
+        if 'tweets' in self.counts:
+            parts.append("%d tweets (%.0f/sec)" % (self.counts['tweets'], self.counts['tweets'] / max(elapsed, 1e-9)))
+        if 'rows' in self.counts:
+            parts.append("%d rows" % self.counts['rows'])
+        n_fetches = sum(sum(histogram) for histogram in self.fetch_latency.values())
+        if n_fetches:
+            n_ok = sum(self.fetch_latency['ok']) if 'ok' in self.fetch_latency else 0
+            parts.append("%d fetches (%.1f%% errors)" % (n_fetches, 100.0 * (n_fetches - n_ok) / n_fetches))
+        parts.extend("%s %.1fs" % (stage, seconds) for stage, seconds in sorted(self.times.items()))
+        self.progress_out.write("%.0fs: %s\n" % (elapsed, ", ".join(parts)))
+        self.progress_out.flush()
+
+    def write(self, path):
+        with open(path, 'w') as fout:
+            json.dump(self.to_dict(), fout, indent=2)
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import ujson as json
+
+# Checkpoints and a ledger of finished input files, so extract_full_tweet_from_json.py can resume an interrupted run
+# (--resume) and can be rerun on a growing directory of inputs, only reading the new files (--skip-done).
+#
+# A checkpoint records how far into the inputs (file, line) all rows have been written, and how many bytes of output
+# that took. The output is written with a tweetIO writer, whose end_member() is called at each checkpoint: with gzip,
+# that ends a gzip member, so the output is a series of them. (gzip, zcat, Python's gzip module and R's gzfile all
+# read a multi-member file as one stream.) So resuming truncates the output back to the last checkpoint and appends
+# new members from there, with no rows lost or written twice.
+
+
+class Checkpointer(object):
+    """ Writes a checkpoint (JSON) to path at most every interval seconds, as chunks of output get written.
+        run_info: what must match for a run to be resumed (e.g., the inputs and output fields); saved with it. """
+
+    def __init__(self, path, interval, fout, run_info):
+        self.path = path
+        self.interval = interval
+        self.fout = fout
+        self.run_info = run_info
+        self.position = None
+        self.next_save = time.time() + interval
+
+    # position: (index into the inputs, lines read from that file) up to which all rows have now been written
+    def chunk_written(self, position):
+        self.position = position
+        if time.time() >= self.next_save:
+            self.save()
+            self.next_save = time.time() + self.interval
+
+    def save(self):
+        if self.position is None:
+            return
+        checkpoint = dict(self.run_info)
+        checkpoint['file_index'], checkpoint['lines_done'] = self.position
+        checkpoint['output_bytes'] = self.fout.end_member()
+        write_atomically(self.path, json.dumps(checkpoint))
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        sys.exit("No checkpoint to resume from (" + path + ")")
+    with open(path, 'r') as fin:
+        return json.load(fin)
+
+
+def write_atomically(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(data)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.rename(tmp_path, path)
+
+
+# The ledger is a text file of input files that have been completely processed, one absolute path per line.
+def load_ledger(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as fin:
+        return set(line.rstrip('\n') for line in fin if line.strip())
+
+
+def add_to_ledger(path, input_paths):
+    with open(path, 'a') as fout:
+        for input_path in input_paths:
+            fout.write(os.path.abspath(input_path) + '\n')
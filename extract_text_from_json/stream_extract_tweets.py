@@ -0,0 +1,363 @@
+import io
+import os
+import sys
+import time
+import Queue
+import signal
+import socket
+import argparse
+import itertools
+import threading
+import multiprocessing
+import tweetURLData
+import whitelistMatcher
+import nbScorer
+import pipelineStats
+import tweetIO
+import extract_full_tweet_from_json as extractor
+
+
+# Long-running version of extract_full_tweet_from_json.py: reads newline-delimited tweet JSON as it arrives (on stdin,
+# or from any number of clients connected to a local socket) and writes the same rows, a micro-batch at a time.
+# A batch is processed and written once it has --batch-size lines or its first line is --batch-seconds old, whichever
+# comes first. So output lags input by about --batch-seconds at most, plus the time to process the batch.
+#
+# Backpressure: lines wait in a queue of at most --max-pending lines. When extraction, URL expansion or whatever reads
+# the output falls behind, the queue fills up and the readers stop reading, so the sender blocks (once the pipe's or
+# socket's buffer is full) instead of this process's memory growing.
+#
+# Runs until the end of stdin, or until SIGINT/SIGTERM, then writes what it has and exits.
+# E.g., to try it out with any program that prints tweets, one per line:
+#   zcat tweets.json.gz | python stream_extract_tweets.py - out.tsv.gz --batch-seconds 2 --progress 10
+
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_BATCH_SECONDS = 5
+DEFAULT_MAX_PENDING = 50000
+# How often (seconds) the main loop and the readers check for a stop signal while waiting (for input, or for room in
+# the queue)
+POLL_INTERVAL = 0.5
+
+# Columns added by --expand-urls: (column, key in expandURLs.expand_url's result) for the page at each row's
+# canonical_url. Filled in for link_type external only.
+EXPANSION_FIELDS = [('landing_url', 'landing_url'), ('status_code', 'status_code'), ('page_canonical_url', 'canonical_url'),
+                    ('title', 'title'), ('description', 'description'), ('author', 'author'),
+                    ('date_published', 'date_published'), ('expand_err', 'err')]
+NO_EXPANSION = ('',) * len(EXPANSION_FIELDS)
+
+# put in the queue by the stdin reader at the end of input
+END_OF_INPUT = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract tweet and URL fields from a stream of JSON tweets into a "
+                                                 "tab-separated file, as they arrive.")
+    parser.add_argument('source', metavar='SOURCE',
+                        help="'-' for stdin, unix:PATH to listen on a Unix socket, or tcp:[HOST:]PORT to listen on a "
+                             "TCP port (HOST defaults to 127.0.0.1). Clients send newline-delimited JSON tweets; "
+                             "any number can be connected at once")
+    parser.add_argument('output', metavar='outFile.tsv.gz',
+                        help="gzipped TSV, with each batch in its own gzip member so the file can be read while it "
+                             "grows (appended to if it exists); or '-' for plain TSV on stdout")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="write a batch once it has this many lines (default %(default)s)")
+    parser.add_argument('--batch-seconds', type=float, default=DEFAULT_BATCH_SECONDS,
+                        help="or once its first line has waited this long (default %(default)s)")
+    parser.add_argument('--max-pending', type=int, default=DEFAULT_MAX_PENDING,
+                        help="stop reading input while this many lines are waiting to be processed "
+                             "(default %(default)s)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes to run extraction in (default 1: no process pool)")
+    parser.add_argument('--whitelist', metavar='whitelist.txt',
+                        help="check each tweet against these terms and add columns " +
+                             ", ".join(tweetURLData.WHITELIST_FIELDS))
+    parser.add_argument('--nb-model', metavar='model-nb-model.tsv',
+                        help="with --whitelist, score each tweet with this naive Bayes model (see "
+                             "extract_full_tweet_from_json.py) and add columns " + ", ".join(nbScorer.SCORE_FIELDS))
+    parser.add_argument('--retweet-cache', type=int, default=extractor.DEFAULT_RETWEET_CACHE_SIZE, metavar='N',
+                        help="as for extract_full_tweet_from_json.py (default %(default)s)")
+    parser.add_argument('--expand-urls', action='store_true',
+                        help="fetch the page of each external URL (see expandURLs.expand_url) and add columns " +
+                             ", ".join(field for field, _ in EXPANSION_FIELDS))
+    parser.add_argument('--url-cache', metavar='url_cache.sqlite',
+                        help="with --expand-urls, keep the results in this urlCache.URLCache")
+    parser.add_argument('--fetch-threads', type=int, default=32,
+                        help="with --expand-urls, pages fetched at once (default %(default)s)")
+    parser.add_argument('--fetch-planner', metavar='fetch_planner_domains.json',
+                        help="with --expand-urls, decide per domain whether to skip, only resolve or fully fetch each "
+                             "URL, starting from the rules in this file (see fetchPlanner.py)")
+    parser.add_argument('--domain-profiles', metavar='domain_profiles.json',
+                        help="with --fetch-planner, load what was learned about each host from this file, and save "
+                             "it back when stopping")
+    parser.add_argument('--stats-file', metavar='stats.json',
+                        help="write time spent per stage and counts to this file, as JSON, when stopping")
+    parser.add_argument('--progress', type=float, default=0, metavar='SECONDS',
+                        help="print a progress line to stderr this often")
+    args = parser.parse_args()
+
+    extract_args = dict(extractor.EXTRACT_ARGS)
+    fields = list(tweetURLData.URL_FIELDS)
+    if args.whitelist:
+        extract_args['whitelist_matcher'] = whitelistMatcher.WhitelistMatcher(whitelistMatcher.load_whitelist(args.whitelist))
+        fields += tweetURLData.WHITELIST_FIELDS
+    nb_scorer = None
+    if args.nb_model:
+        if not args.whitelist:
+            parser.error("--nb-model needs --whitelist (the model was trained on text with the whitelist terms removed)")
+        nb_scorer = nbScorer.NBScorer(args.nb_model)
+        fields += nbScorer.SCORE_FIELDS
+    expander = None
+    if args.expand_urls:
+        expander = URLExpander(fields, args.url_cache, args.fetch_threads, args.fetch_planner, args.domain_profiles)
+        fields += [field for field, _ in EXPANSION_FIELDS]
+
+    stats = None
+    if args.stats_file or args.progress:
+        stats = pipelineStats.PipelineStats(progress_interval=args.progress)
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stopping.set())
+
+    pending = Queue.Queue(maxsize=args.max_pending)
+    start_readers(args.source, pending, stopping)
+
+    if args.workers <= 1:
+        pool = None
+        extractor.init_worker(tweetURLData.extract_urls_from_tweet, extract_args, stats is not None, args.retweet_cache,
+                              nb_scorer)
+    else:
+        # (workers ignore the signals; the main process stops them once it has written what it has)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        pool = multiprocessing.Pool(args.workers, initializer=extractor.init_worker,
+                                    initargs=(tweetURLData.extract_urls_from_tweet, extract_args, stats is not None,
+                                              args.retweet_cache, nb_scorer))
+        signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+    chunk_size = max(1, min(extractor.DEFAULT_CHUNK_SIZE, args.batch_size // max(args.workers, 1)))
+
+    fout, flush = open_output(args.output)
+    try:
+        wrtr = extractor.TSVWriter(fout)
+        if args.output == '-' or os.path.getsize(args.output) == 0:
+            wrtr.writerow(fields)
+            flush()
+        ended = False
+        while not ended:
+            lines, ended = next_batch(pending, args.batch_size, args.batch_seconds, stopping)
+            if not lines:
+                continue
+            rows = extract_batch(lines, pool, chunk_size, stats)
+            if expander is not None:
+                rows = expander.add_expansions(rows, stats)
+            start = time.time()
+            wrtr.writerows(rows)
+            flush()
+            if stats is not None:
+                stats.add_time('write', time.time() - start)
+                stats.count('rows', len(rows))
+                stats.count('batches')
+                stats.maybe_report()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if fout is not sys.stdout:
+            fout.close()
+
+    if expander is not None and expander.planner is not None and args.domain_profiles:
+        expander.planner.save()
+    if stats is not None:
+        if expander is not None and expander.url_cache is not None:
+            for name, n in expander.url_cache.stats().iteritems():
+                if isinstance(n, (int, long)):
+                    stats.count('url_cache_' + name, n)
+        if expander is not None and expander.planner is not None:
+            for name, n in expander.planner.stats().iteritems():
+                stats.count('fetch_plan_' + name, n)
+        if args.progress:
+            stats.report()
+        if args.stats_file:
+            stats.write(args.stats_file)
+
+
+# Returns (file object, function to call after each batch). The gzip file gets a new member per batch, so whatever
+# has been flushed can be read (zcat, R's gzfile) even while the daemon is still running.
+def open_output(output_path):
+    if output_path == '-':
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)   # (quietly stop if the reader goes away)
+        return sys.stdout, sys.stdout.flush
+    resume_offset = os.path.getsize(output_path) if os.path.exists(output_path) else None
+    fout = tweetIO.GzipMemberWriter(output_path, resume_offset=resume_offset)
+    return fout, fout.end_member
+
+
+def start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+# Starts the thread(s) that read lines into the pending queue: one for stdin, or one accepting socket connections
+# plus one per connection.
+def start_readers(source, pending, stopping):
+    if source == '-':
+        # (stdin through an io buffer: sys.stdin reads a byte per system call when python runs unbuffered, as with
+        # PYTHONUNBUFFERED=1 or -u; an io reader's readline takes whatever has arrived and still returns each line
+        # as soon as it's complete)
+        start_thread(read_lines, io.open(sys.stdin.fileno(), 'rb', closefd=False), pending, stopping, True)
+        return
+    kind, _, address = source.partition(':')
+    if kind == 'unix':
+        if os.path.exists(address):
+            os.remove(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+    elif kind == 'tcp':
+        host, _, port = address.rpartition(':')
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host or '127.0.0.1', int(port)))
+    else:
+        sys.exit("Unknown source " + source + " (use -, unix:PATH or tcp:[HOST:]PORT)")
+    server.listen(16)
+    start_thread(accept_clients, server, pending, stopping)
+
+
+def accept_clients(server, pending, stopping):
+    while True:
+        conn, _ = server.accept()
+        start_thread(read_lines, conn.makefile('rb'), pending, stopping, False)
+
+
+# readline rather than iterating over fin, whose read-ahead buffer would hold back lines until 8 KB had arrived.
+# Waiting while the queue is full is what pushes back on the sender. Once stopping, readers quit rather than wait.
+def read_lines(fin, pending, stopping, end_of_input):
+    try:
+        for line in iter(fin.readline, ''):
+            if line.strip() and not put_unless_stopping(pending, line, stopping):
+                return
+    finally:
+        fin.close()
+        if end_of_input:
+            put_unless_stopping(pending, END_OF_INPUT, stopping)
+
+
+def put_unless_stopping(pending, item, stopping):
+    while not stopping.is_set():
+        try:
+            pending.put(item, timeout=POLL_INTERVAL)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+# Waits for the next batch of lines. Returns (lines, whether the input has ended or a stop signal arrived).
+def next_batch(pending, batch_size, batch_seconds, stopping):
+    lines = []
+    deadline = None
+    while len(lines) < batch_size:
+        # (checked on every line, not only when input is idle, so a steady stream can't keep the daemon from stopping)
+        if stopping.is_set():
+            return lines, True
+        timeout = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.time())
+        if timeout <= 0:
+            break
+        try:
+            line = pending.get(timeout=timeout)
+        except Queue.Empty:
+            continue
+        if line is END_OF_INPUT:
+            return lines, True
+        lines.append(line)
+        if deadline is None:
+            deadline = time.time() + batch_seconds
+    return lines, False
+
+
+def extract_batch(lines, pool, chunk_size, stats):
+    chunks = [lines[i:i + chunk_size] for i in xrange(0, len(lines), chunk_size)]
+    if pool is None:
+        results = itertools.imap(extract_chunk_skipping_bad, chunks)
+    else:
+        results = pool.imap(extract_chunk_skipping_bad, chunks)
+    rows = []
+    for chunk_rows, chunk_stats in results:
+        rows.extend(chunk_rows)
+        if stats is not None and chunk_stats is not None:
+            stats.merge(chunk_stats)
+    return rows
+
+
+# extractor.extract_chunk, except that a line that can't be parsed or extracted (say, one cut off by a client
+# disconnecting) is reported and skipped, rather than stopping the daemon.
+def extract_chunk_skipping_bad(lines):
+    try:
+        return extractor.extract_chunk(lines)
+    except Exception:
+        pass
+    if extractor.worker_stats is not None:
+        extractor.worker_stats.take()   # (drop whatever the failed attempt counted)
+    rows = []
+    chunk_stats = pipelineStats.PipelineStats()
+    for line in lines:
+        try:
+            line_rows, line_stats = extractor.extract_chunk([line])
+        except Exception as e:
+            sys.stderr.write("Skipped a line (%s: %s): %r\n" % (e.__class__.__name__, e, line[:100]))
+            chunk_stats.count('lines_skipped')
+            if extractor.worker_stats is not None:
+                extractor.worker_stats.take()
+            continue
+        rows.extend(line_rows)
+        if line_stats is not None:
+            chunk_stats.merge(line_stats)
+    return rows, chunk_stats.to_dict() if extractor.worker_stats is not None else None
+
+
+# Adds EXPANSION_FIELDS to rows, fetching each distinct external URL of a batch once
+# (expandURLs.expand_url_batch, through the url cache and fetch planner if there are any).
+class URLExpander(object):
+
+    def __init__(self, fields, url_cache_path=None, num_threads=32, planner_config_path=None, profiles_path=None):
+        import expandURLs   # (needs requests and lxml, which nothing else here does)
+        self.expand_url_batch = expandURLs.expand_url_batch
+        self.url_cache = None
+        if url_cache_path is not None:
+            import urlCache
+            self.url_cache = urlCache.URLCache(url_cache_path)
+        self.planner = None
+        if planner_config_path is not None:
+            import fetchPlanner
+            self.planner = fetchPlanner.FetchPlanner(planner_config_path, profiles_path)
+        self.num_threads = num_threads
+        self.url_index = fields.index('canonical_url')
+        self.link_type_index = fields.index('link_type')
+
+    def add_expansions(self, rows, stats=None):
+        start = time.time()
+        urls = sorted(set(row[self.url_index] for row in rows if row[self.link_type_index] == 'external'))
+        results = dict(zip(urls, self.expand_url_batch(urls, cache=self.url_cache, num_threads=self.num_threads,
+                                                       stats=stats, planner=self.planner)))
+        expanded_rows = []
+        for row in rows:
+            res = results.get(row[self.url_index]) if row[self.link_type_index] == 'external' else None
+            expanded_rows.append(row + (expansion_values(res) if res is not None else NO_EXPANSION))
+        if stats is not None:
+            stats.add_time('expand', time.time() - start)
+        return expanded_rows
+
+
+# (parse_page's values are utf8 byte strings)
+def expansion_values(res):
+    values = []
+    for _, key in EXPANSION_FIELDS:
+        value = res.get(key, '')
+        if isinstance(value, str):
+            value = value.decode('utf8', 'replace')
+        values.append(tweetURLData.strip_newlines(value) if value != '' else '')
+    return tuple(values)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 
 import re
+import datetime
 
 # Pull out non-URL data about tweet. Returns a dictionary (filling in the fields listed just below).
-def extract_tweet_info(json):
+# original_info: for a retweet, its ORIGINAL_FIELDS as extracted from an earlier retweet of the same status
+#   (see tweetURLData.RetweetCache); then only the retweet's own fields are read from the json.
+def extract_tweet_info(json, original_info=None):
     data = {'user_id': json['user']['id_str'],
             'screen_name': json['user']['screen_name'],
             'tweet_id': json['id_str'],
@@ -24,9 +27,12 @@ def extract_tweet_info(json):
                (json.has_key('in_reply_to_user_id_str') and json['in_reply_to_user_id_str'] is not None)
     is_quote = json['is_quote_status']
 
-    data['tweet_text'] = get_text_field(json)
+    if original_info is not None:
+        data.update(original_info)
+    else:
+        data['tweet_text'] = get_text_field(json)
 
-    if is_retweet:   # grab original (non-truncated) text, plus save the "RT @username: " prefix
+    if is_retweet and original_info is None:   # grab original (non-truncated) text, plus save the "RT @username: " prefix
         data['retweet_prefix'] = 'RT @' + json['retweeted_status']['user']['screen_name'] + ": "
         data['tweet_text'] = get_text_field(json['retweeted_status'])
         data['retweet_of_tweet_id'] = json['retweeted_status']['id_str']
@@ -45,7 +51,9 @@ def extract_tweet_info(json):
 
         # go get the text being quoted and user
 
-        if is_retweet and json['retweeted_status'].has_key('quoted_status'):
+        if original_info is not None:
+            pass    # (have them already)
+        elif is_retweet and json['retweeted_status'].has_key('quoted_status'):
             data['quote_of_user_id'] = json['retweeted_status']['quoted_status']['user']['id_str']
             data['quote_of_user_name'] = json['retweeted_status']['quoted_status']['user']['screen_name']
             data['quoted_text'] = get_text_field(json['retweeted_status']['quoted_status'])
@@ -59,9 +67,18 @@ def extract_tweet_info(json):
 
     return data
 
+# Fields of extract_tweet_info that, for a retweet, come from the retweeted status (and what it quotes)
+# rather than from the retweet itself
+ORIGINAL_FIELDS = ['tweet_text', 'retweet_prefix', 'quoted_text', 'retweet_of_tweet_id', 'retweet_of_user_id',
+                   'quote_of_user_name']
+
 # gets top-level text field from the json element passed in, either 'full_text' (optionally dipping into extended_tweet) or 'text'
 bad_chars = re.compile('[\r\n\t]+')
 def get_text_field(json):
+    return bad_chars.sub(' ', get_raw_text_field(json))
+
+# same, but without cleaning up whitespace (so that entity indices still line up with it)
+def get_raw_text_field(json):
     txt = ''
     if 'full_text' in json:
         txt = json['full_text']
@@ -69,5 +86,40 @@ def get_text_field(json):
         txt = json['extended_tweet']['full_text']
     else:
         txt = json.get('text', '')
-    return bad_chars.sub(' ', txt)
+    return txt
+
+
+# Dates: created_at is always in TWITTER_DATE_FORMAT, so it's parsed by position rather than with strptime,
+# and each day's date is only built once.
+TWITTER_DATE_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+tweet_dates = {}   # "Oct 01 2016" -> date
+
+def parse_tweet_date(created_at):
+    if len(created_at) != 30 or created_at[19:26] != ' +0000 ':
+        return datetime.datetime.strptime(created_at, TWITTER_DATE_FORMAT).date()   # (raises ValueError)
+    key = created_at[4:11] + created_at[26:]
+    date = tweet_dates.get(key)
+    if date is None:
+        date = datetime.date(int(created_at[26:]), MONTHS[created_at[4:7]], int(created_at[8:10]))
+        tweet_dates[key] = date
+    return date
+
+def parse_tweet_datetime(created_at):
+    date = parse_tweet_date(created_at)
+    return datetime.datetime(date.year, date.month, date.day,
+                             int(created_at[11:13]), int(created_at[14:16]), int(created_at[17:19]))
+
+# created_at of a raw (not yet parsed) JSON line, if it's the first field of the status, as in Twitter's own output;
+# otherwise None. Lets a date filter skip lines without parsing them.
+CREATED_AT_PATTERN = re.compile(r'\{\s*"created_at"\s*:\s*"([^"\\]*)"')
+def peek_created_at(line):
+    m = CREATED_AT_PATTERN.match(line)
+    return m.group(1) if m is not None else None
 
+# Same for the tweet's ID, if created_at and then id are the first fields (as Twitter writes them); otherwise None.
+TWEET_ID_PATTERN = re.compile(r'\{\s*"created_at"\s*:\s*"[^"\\]*"\s*,\s*"id"\s*:\s*(\d+)\s*[,}]')
+def peek_tweet_id(line):
+    m = TWEET_ID_PATTERN.match(line)
+    return m.group(1) if m is not None else None
@@ -0,0 +1,400 @@
+import io
+import os
+import sys
+import zlib
+import gzip
+import mmap
+import Queue
+import struct
+import threading
+import contextlib
+import collections
+from multiprocessing.pool import ThreadPool
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Input and output codecs for the extractor:
+#   gzip      - plain gzip, as collectors write it. Read in a background thread (zlib releases the GIL, so decompressing
+#               overlaps with everything else); written as usual, single-threaded.
+#   blockgzip - BGZF-style: a series of gzip members ("blocks"), each holding about BLOCK_SIZE bytes of whole lines,
+#               whose headers record the block's compressed size and number of lines. Blocks are compressed and
+#               decompressed by a pool of threads. Since every block can be found from the headers alone, a file can
+#               be split among workers without decompressing it first (block_ranges(), read_block_range()). It's
+#               still a valid gzip file, so zcat, R's gzfile etc. read it as usual.
+#   zstd      - Zstandard, compressed with several threads. Needs the zstandard package (pip install zstandard).
+#   plain     - uncompressed; read through mmap.
+# The codec of an input file is recognized from its first bytes (open_lines()). Output codecs are chosen by name
+# (open_output()). To add a codec, add its reader to INPUT_CODECS (and to detect_codec()) and its writer to
+# OUTPUT_CODECS.
+#
+# Writers have write(), close() and end_member(). end_member() makes everything written so far readable on its own
+# and durable, and returns the file's size at that point. That's where runCheckpoint's checkpoints cut the output,
+# so output in any codec can be checkpointed and resumed (resume_offset).
+
+BLOCK_SIZE = 1024 * 1024        # (uncompressed) bytes per blockgzip block
+BLOCK_LEVEL = 6                 # zlib's default; much faster than gzip's 9 for a slightly bigger file
+ZSTD_LEVEL = 3
+DEFAULT_THREADS = 4
+READ_SIZE = 1024 * 1024         # bytes decompressed at a time by readers
+READ_AHEAD = 4                  # READ_SIZEs (or blocks per thread) decompressed ahead of use
+# How often (seconds) a read-ahead thread checks whether it's still wanted
+POLL_INTERVAL = 0.5
+
+# A blockgzip block's header: a gzip header (FLG.FEXTRA set) whose extra field has one subfield, 'LB', giving the
+# block's total size in bytes (header and trailer included) and its number of lines. Then raw deflate data, and the
+# usual CRC32 and ISIZE.
+BLOCK_HEADER = struct.Struct('<4sIBBH2sHII')
+BLOCK_MAGIC = '\x1f\x8b\x08\x04'
+BLOCK_SUBFIELD = 'LB'
+BLOCK_TRAILER = struct.Struct('<II')
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+# Part of a blockgzip file: the consecutive blocks in [offset, offset + size), minus their first skip_lines lines
+BlockRange = collections.namedtuple('BlockRange', ['path', 'offset', 'size', 'skip_lines'])
+
+
+def detect_codec(path):
+    with open(path, 'rb') as fin:
+        start = fin.read(BLOCK_HEADER.size)
+    if start.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if start.startswith(GZIP_MAGIC):
+        return 'blockgzip' if is_block_header(start) else 'gzip'
+    return 'plain'
+
+
+# The output codec to use when none is given: by the file's extension, else gzip (as always).
+def codec_for_path(path):
+    return 'zstd' if path.endswith('.zst') else 'gzip'
+
+
+# Yields an iterator over the lines of the file, whatever its codec. threads: for decompressing blockgzip.
+@contextlib.contextmanager
+def open_lines(path, threads=DEFAULT_THREADS):
+    reader = INPUT_CODECS[detect_codec(path)]
+    with open(path, 'rb') as fin:
+        lines = reader(fin, threads)
+        try:
+            yield lines
+        finally:
+            lines.close()
+
+
+def open_output(path, codec, threads=DEFAULT_THREADS, resume_offset=None):
+    """ A writer for path in the codec. resume_offset: truncate the existing file to this size (an offset returned
+        by end_member()) and add to it. """
+    return OUTPUT_CODECS[codec](path, threads=threads, resume_offset=resume_offset)
+
+
+def read_gzip_lines(fin, threads):
+    gzip_file = gzip.GzipFile(fileobj=fin, mode='rb')
+    return split_lines(read_ahead(iter(lambda: gzip_file.read(READ_SIZE), '')))
+
+
+def read_blockgzip_lines(fin, threads):
+    return split_lines(ordered_map(decompress_block, read_blocks(fin), threads))
+
+
+def read_zstd_lines(fin, threads):
+    if zstandard is None:
+        raise ImportError("Reading zstd files needs the zstandard package (pip install zstandard)")
+    reader = zstandard.ZstdDecompressor().stream_reader(fin, read_across_frames=True)
+    return split_lines(read_ahead(iter(lambda: reader.read(READ_SIZE), '')))
+
+
+def read_plain_lines(fin, threads):
+    if os.fstat(fin.fileno()).st_size == 0:
+        return   # (mmap can't map an empty file)
+    mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for line in iter(mapped.readline, ''):
+            yield line
+    finally:
+        mapped.close()
+
+
+INPUT_CODECS = {'gzip': read_gzip_lines, 'blockgzip': read_blockgzip_lines, 'zstd': read_zstd_lines,
+                'plain': read_plain_lines}
+
+
+# Lines from an iterator of pieces of text (lines can span pieces). Splits at '\n' only.
+def split_lines(pieces):
+    partial = ''
+    for piece in pieces:
+        lines = io.BytesIO(piece).readlines()
+        if not lines:
+            continue
+        if partial:
+            lines[0] = partial + lines[0]
+        partial = '' if lines[-1].endswith('\n') else lines.pop()
+        for line in lines:
+            yield line
+    if partial:
+        yield partial
+
+
+# Runs through items in a background thread, keeping up to depth of them ready. Exceptions are raised in the caller.
+def read_ahead(items, depth=READ_AHEAD):
+    ready = Queue.Queue(depth)
+    stopping = threading.Event()
+
+    def put(item):
+        while not stopping.is_set():
+            try:
+                ready.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+            put((None, None))
+        except Exception:
+            put((None, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = ready.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if item is None:
+                return
+            yield item
+    finally:
+        stopping.set()
+        thread.join()
+
+
+# itertools.imap(func, items), with func run on up to threads * READ_AHEAD items at a time by a pool of threads.
+def ordered_map(func, items, threads):
+    pool = ThreadPool(threads)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= threads * READ_AHEAD:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def is_block_header(header):
+    if len(header) < BLOCK_HEADER.size:
+        return False
+    magic, mtime, xfl, os_code, xlen, subfield, subfield_len, size, n_lines = BLOCK_HEADER.unpack(header)
+    return magic == BLOCK_MAGIC and xlen == 12 and subfield == BLOCK_SUBFIELD and subfield_len == 8
+
+
+# (total size, number of lines) of the block that starts with header
+def read_block_header(header):
+    if not is_block_header(header):
+        raise IOError("Not a blockgzip block")
+    return BLOCK_HEADER.unpack(header)[-2:]
+
+
+def compress_block(data, level=BLOCK_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    n_lines = data.count('\n') + int(bool(data) and not data.endswith('\n'))
+    size = BLOCK_HEADER.size + len(deflated) + BLOCK_TRAILER.size
+    return (BLOCK_HEADER.pack(BLOCK_MAGIC, 0, 0, 255, 12, BLOCK_SUBFIELD, 8, size, n_lines) + deflated +
+            BLOCK_TRAILER.pack(zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff))
+
+
+def decompress_block(block):
+    data = zlib.decompress(block[BLOCK_HEADER.size:-BLOCK_TRAILER.size], -zlib.MAX_WBITS)
+    crc, isize = BLOCK_TRAILER.unpack(block[-BLOCK_TRAILER.size:])
+    if crc != zlib.crc32(data) & 0xffffffff or isize != len(data) & 0xffffffff:
+        raise IOError("CRC check failed in blockgzip block")
+    return data
+
+
+# Yields each (compressed) block of a blockgzip file, reading from the current position.
+def read_blocks(fin):
+    while True:
+        header = fin.read(BLOCK_HEADER.size)
+        if not header:
+            return
+        size, n_lines = read_block_header(header)
+        block = header + fin.read(size - BLOCK_HEADER.size)
+        if len(block) < size:
+            raise EOFError("blockgzip file ended in the middle of a block")
+        yield block
+
+
+def block_ranges(path, lines_per_range):
+    """ Splits a blockgzip file into BlockRanges of consecutive blocks with at least lines_per_range lines each
+        (except the last), reading only the block headers. Returns a list of (BlockRange, number of lines). """
+    ranges = []
+    with open(path, 'rb') as fin:
+        file_size = os.fstat(fin.fileno()).st_size
+        offset = range_start = range_lines = 0
+        while offset < file_size:
+            fin.seek(offset)
+            size, n_lines = read_block_header(fin.read(BLOCK_HEADER.size))
+            if offset + size > file_size:
+                raise EOFError("blockgzip file ended in the middle of a block")
+            offset += size
+            range_lines += n_lines
+            if range_lines >= lines_per_range:
+                ranges.append((BlockRange(path, range_start, offset - range_start, 0), range_lines))
+                range_start = offset
+                range_lines = 0
+    if range_lines > 0:
+        ranges.append((BlockRange(path, range_start, offset - range_start, 0), range_lines))
+    return ranges
+
+
+def read_block_range(block_range):
+    """ The lines in a BlockRange, as a list. """
+    with open(block_range.path, 'rb') as fin:
+        fin.seek(block_range.offset)
+        data = fin.read(block_range.size)
+    blocks = read_blocks(io.BytesIO(data))
+    return list(split_lines(decompress_block(block) for block in blocks))[block_range.skip_lines:]
+
+
+def open_for_writing(path, resume_offset=None):
+    if resume_offset is None:
+        return open(path, 'wb')
+    raw = open(path, 'r+b')
+    raw.seek(resume_offset)
+    raw.truncate()
+    return raw
+
+
+def sync(raw):
+    raw.flush()
+    os.fsync(raw.fileno())
+    return raw.tell()
+
+
+class GzipMemberWriter(object):
+    """ Writes a gzip file (with the gzip module, at its default level, 9). end_member() finishes the current gzip
+        member and starts another. """
+
+    def __init__(self, path, threads=None, resume_offset=None):
+        self.raw = open_for_writing(path, resume_offset)
+        self.member = gzip.GzipFile(fileobj=self.raw, mode='wb')
+
+    def write(self, data):
+        self.member.write(data)
+
+    def end_member(self):
+        self.member.close()   # (leaves self.raw open)
+        offset = sync(self.raw)
+        self.member = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        return offset
+
+    def close(self):
+        self.member.close()
+        self.raw.close()
+
+
+class BlockGzipWriter(object):
+    """ Writes a blockgzip file, compressing blocks with a pool of threads. Blocks end at the last line that fits
+        (a block can only be bigger than block_size if a single line is), and at end_member(). """
+
+    def __init__(self, path, threads=DEFAULT_THREADS, resume_offset=None, block_size=BLOCK_SIZE, level=BLOCK_LEVEL):
+        self.raw = open_for_writing(path, resume_offset)
+        self.threads = threads
+        self.block_size = block_size
+        self.level = level
+        self.buffer = []
+        self.buffered = 0
+        self.pool = None   # (started with the first block, e.g. after any worker processes are forked)
+        self.pending = collections.deque()
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self.start_block(whole_lines=True)
+
+    def start_block(self, whole_lines):
+        data = ''.join(self.buffer)
+        end = data.rfind('\n') + 1 if whole_lines else len(data)
+        if end == 0:
+            self.buffer = [data]
+            return
+        self.buffer = [data[end:]]
+        self.buffered = len(data) - end
+        if self.pool is None:
+            self.pool = ThreadPool(self.threads)
+        self.pending.append(self.pool.apply_async(compress_block, (data[:end], self.level)))
+        while self.pending and (len(self.pending) > self.threads * READ_AHEAD or self.pending[0].ready()):
+            self.raw.write(self.pending.popleft().get())
+
+    def finish_blocks(self):
+        if self.buffered:
+            self.start_block(whole_lines=False)
+        while self.pending:
+            self.raw.write(self.pending.popleft().get())
+
+    def end_member(self):
+        self.finish_blocks()
+        return sync(self.raw)
+
+    def close(self):
+        self.finish_blocks()
+        self.raw.write(compress_block(''))   # an empty block marks the end of the file, as in BGZF
+        self.raw.close()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+class ZstdWriter(object):
+    """ Writes a zstd file (frames ending at each end_member()), compressed by zstd's own threads. """
+
+    def __init__(self, path, threads=DEFAULT_THREADS, resume_offset=None, level=ZSTD_LEVEL):
+        if zstandard is None:
+            raise ImportError("zstd output needs the zstandard package (pip install zstandard)")
+        self.raw = open_for_writing(path, resume_offset)
+        self.compressor = zstandard.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+        self.frame = self.compressor.compressobj()
+
+    def write(self, data):
+        compressed = self.frame.compress(data)
+        if compressed:
+            self.raw.write(compressed)
+
+    def end_member(self):
+        self.raw.write(self.frame.flush())
+        self.frame = self.compressor.compressobj()
+        return sync(self.raw)
+
+    def close(self):
+        self.raw.write(self.frame.flush())
+        self.raw.close()
+
+
+class PlainWriter(object):
+
+    def __init__(self, path, threads=None, resume_offset=None):
+        self.raw = open_for_writing(path, resume_offset)
+
+    def write(self, data):
+        self.raw.write(data)
+
+    def end_member(self):
+        return sync(self.raw)
+
+    def close(self):
+        self.raw.close()
+
+
+OUTPUT_CODECS = {'gzip': GzipMemberWriter, 'blockgzip': BlockGzipWriter, 'zstd': ZstdWriter, 'plain': PlainWriter}
@@ -0,0 +1,71 @@
+import os
+import bisect
+from array import array
+
+# Set of tweet IDs, for skipping tweets already seen (in this run or, via the saved file, in earlier ones).
+# IDs are kept in a sorted array of 64-bit ints (8 bytes each, looked up by binary search), plus a regular set of
+# recently added IDs that gets merged into the array once it holds merge_threshold of them. So 100 million IDs take
+# about 800 MB, rather than the several GB a Python set of them would.
+# The file format is just the sorted array: native-endian unsigned 64-bit ints.
+
+# Python 2's array has no 'Q'; 'L' (unsigned long) is 64 bits on 64-bit Linux and macOS.
+TYPECODE = 'L'
+
+
+class TweetIdSet(object):
+
+    def __init__(self, path=None, merge_threshold=1000000):
+        """ path: file to load IDs from, if it exists (and the default place save() writes to). """
+        self.path = path
+        self.merge_threshold = merge_threshold
+        self.ids = array(TYPECODE)
+        if self.ids.itemsize != 8:
+            raise ValueError("TweetIdSet needs a platform where array('%s') holds 64-bit ints" % TYPECODE)
+        self.recent = set()
+        if path is not None and os.path.exists(path):
+            with open(path, 'rb') as fin:
+                self.ids.fromfile(fin, os.path.getsize(path) // self.ids.itemsize)
+
+    def __len__(self):
+        return len(self.ids) + len(self.recent)
+
+    def __contains__(self, tweet_id):
+        tweet_id = int(tweet_id)
+        if tweet_id in self.recent:
+            return True
+        i = bisect.bisect_left(self.ids, tweet_id)
+        return i < len(self.ids) and self.ids[i] == tweet_id
+
+    def add(self, tweet_id):
+        """ Adds tweet_id (an int or string of digits). Returns True if it's new, False if it was already there. """
+        tweet_id = int(tweet_id)
+        if tweet_id in self:
+            return False
+        self.recent.add(tweet_id)
+        if len(self.recent) >= self.merge_threshold:
+            self.merge()
+        return True
+
+    def merge(self):
+        """ Moves the recently added IDs into the sorted array. """
+        if not self.recent:
+            return
+        merged = array(TYPECODE)
+        prev = 0
+        for tweet_id in sorted(self.recent):
+            i = bisect.bisect_left(self.ids, tweet_id, prev)
+            merged.extend(self.ids[prev:i])   # (array slices are copied in one go)
+            merged.append(tweet_id)
+            prev = i
+        merged.extend(self.ids[prev:])
+        self.ids = merged
+        self.recent = set()
+
+    def save(self, path=None):
+        """ Writes all IDs to path (default: the one loaded from), replacing the file only once it's complete. """
+        path = path or self.path
+        self.merge()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            self.ids.tofile(fout)
+        os.rename(tmp_path, path)
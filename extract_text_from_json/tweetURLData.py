@@ -1,6 +1,7 @@
 import re
-import datetime
-from tweetData import extract_tweet_info
+from collections import OrderedDict
+from tweetData import extract_tweet_info, get_raw_text_field, bad_chars, parse_tweet_date, peek_created_at, \
+    ORIGINAL_FIELDS
 
 # This module pulls out the URLs in tweets.
 # Describes them by (1) what they point to = link_type
@@ -36,8 +37,24 @@ if oldFormat:
                   'link_type', 'shortened_url', 'canonical_url', 'website', 'title',
                   'date_published', 'description', 'author']
 
+# extra fields when tweets are checked against a whitelist (see whitelist_matcher below)
+WHITELIST_FIELDS = ['classifier_label', 'white_terms']
+
 TWEET_URL_PATTERN = re.compile('.*twitter\.com/(.*)/status/(\d+)($|/.*)$')
 URL_PATTERN = re.compile('https?://([^/]+)')
+QUOTE_LINK_PATTERN = re.compile(r'(?<!\w)https?://t\.co/\S+\s*$', re.UNICODE)
+
+
+# Rows are tuples, in the order of URL_FIELDS: the tweet-level fields, then the URL-level ones (empty strings
+# for a tweet without URLs), then WHITELIST_FIELDS if a whitelist_matcher is used.
+TWEET_INFO_FIELDS = URL_FIELDS[:URL_FIELDS.index('where_url_found')]
+URL_INFO_FIELDS = URL_FIELDS[len(TWEET_INFO_FIELDS):]
+NO_URL_INFO = ('',) * len(URL_INFO_FIELDS)
+
+# Fields that can hold arbitrary text, and so go through strip_newlines for the TSV. (The others are IDs, dates,
+# screen names and labels, which can't contain tabs, newlines or quotes.)
+TEXT_FIELDS = set(['tweet_text', 'quoted_text', 'shortened_url', 'canonical_url', 'website', 'white_terms',
+                   'complete_raw_text', 'urls', 'title', 'description', 'author', 'date_published'])
 
 
 # extract_urls_from_tweet optional arguments:
@@ -45,70 +62,340 @@ URL_PATTERN = re.compile('https?://([^/]+)')
 #   include_non_url_tweets -- True means print a line for each tweet even if it has no URLs
 #   show_internal_twitter -- True means print lines even for URLs that point to Twitter (will have link_type: twitter_status or twitter_media);
 #                the default, False, only prints lines for external (non-Twitter) URLs.
+#   whitelist_matcher -- a whitelistMatcher.WhitelistMatcher. If given, each line also gets WHITELIST_FIELDS:
+#                classifier_label (TRUE/FALSE) and white_terms, found in the same text the R classifier would use.
+#   escape_text -- True (default) makes text fields unicode strings safe to write to the TSV (see strip_newlines);
+#                False leaves values as they are (e.g., for columnarWriter).
+#   stats -- a pipelineStats.PipelineStats, to record time spent in stages 'entities', 'whitelist' and 'rows',
+#                and counts of tweets by kind and URLs by link_type (see count_tweet).
+#   retweet_cache -- a RetweetCache, so that retweets of the same status reuse what was extracted from it.
+#   score_batch -- an nbScorer.ScoreBatch (needs whitelist_matcher). Each tweet's naive Bayes terms are added to it,
+#                and its finish() then appends nbScorer.SCORE_FIELDS to the rows. Time goes to stage 'classifier'.
+# Returns a list of rows (tuples; see URL_FIELDS above), one per URL.
 def extract_urls_from_tweet(t, earliest_date=None, latest_date=None,
                             show_internal_twitter=False,
-                            include_non_url_tweets=False):
+                            include_non_url_tweets=False,
+                            whitelist_matcher=None,
+                            escape_text=True,
+                            stats=None,
+                            retweet_cache=None,
+                            score_batch=None):
+
+    if stats is not None:
+        stats.mark()
+    if not in_date_range(t, earliest_date, latest_date):
+        if stats is not None:
+            stats.count('tweets_date_filtered')
+        return []
+
+    # Get non-URL fields
+    cached = get_retweet_cache_entry(retweet_cache, t, show_internal_twitter, stats)
+    tweet_info = extract_tweet_info_cached(t, cached)
+
+    whitelist_part = ()
+    if whitelist_matcher is not None:
+        if stats is not None:
+            stats.lap('entities')
+        complete_raw_text = from_cache(cached, 'complete_raw_text', construct_complete_raw_text, t, tweet_info)
+        whitelist_part, nb_terms = whitelist_and_terms(cached, whitelist_matcher, score_batch, complete_raw_text, stats)
+
+    url_infos = from_cache(cached, 'url_infos', get_tweet_urls, t, show_internal_twitter)
+    if stats is not None:
+        stats.lap('entities')
+        count_tweet(stats, tweet_info, url_infos, whitelist_part)
+
+    # tweet-level fields are shared by (and escaped once for) all of the tweet's rows
+    tweet_part = row_values(tweet_info, TWEET_INFO_FIELDS, escape_text)
+    whitelist_part = row_values_escaped(whitelist_part, escape_text)
+    res = [tweet_part + row_values(url_info, URL_INFO_FIELDS, escape_text) + whitelist_part
+           for url_info in url_infos]
+
+    if not len(res) and include_non_url_tweets:
+        res.append(tweet_part + NO_URL_INFO + whitelist_part)
+    if score_batch is not None:
+        score_batch.add(len(res), nb_terms, whitelist_part[0] == 'TRUE')
+
+    if stats is not None:
+        stats.lap('rows')
+    return res
+
+
+# fields for extract_tweet_row: one line per tweet (whether or not it has URLs). In place of tweet_text and quoted_text,
+# has complete_raw_text, the text the R classifier uses (see construct_complete_raw_text).
+# 'urls' lists the tweet's URLs, separated by spaces, each as <where_url_found>,<link_type>,<canonical_url>.
+TWEET_FIELDS = ['tweet_id', 'user_id', 'screen_name', 'tweet_date', 'retweet_prefix',
+                'retweet_of_tweet_id', 'retweet_of_user_id',
+                'quote_of_tweet_id', 'quote_of_user_name', 'reply_to_tweet_id',
+                'complete_raw_text', 'urls']
+
+
+# Alternative to extract_urls_from_tweet that returns (a list containing) one line per tweet, with fields TWEET_FIELDS
+# (plus WHITELIST_FIELDS if whitelist_matcher is given). Optional arguments are as for extract_urls_from_tweet;
+# show_internal_twitter only affects which URLs are listed in 'urls' (t.co links in the text are always expanded).
+def extract_tweet_row(t, earliest_date=None, latest_date=None,
+                      show_internal_twitter=False,
+                      whitelist_matcher=None,
+                      escape_text=True,
+                      stats=None,
+                      retweet_cache=None,
+                      score_batch=None):
+
+    if stats is not None:
+        stats.mark()
+    if not in_date_range(t, earliest_date, latest_date):
+        if stats is not None:
+            stats.count('tweets_date_filtered')
+        return []
+
+    cached = get_retweet_cache_entry(retweet_cache, t, show_internal_twitter, stats)
+    tweet_info = extract_tweet_info_cached(t, cached)
+    tweet_info['complete_raw_text'] = from_cache(cached, 'complete_raw_text', construct_complete_raw_text, t, tweet_info)
+    url_infos = from_cache(cached, 'url_infos', get_tweet_urls, t, show_internal_twitter)
+    tweet_info['urls'] = from_cache(cached, 'urls', urls_field, url_infos)
+    whitelist_part = ()
+    if stats is not None:
+        stats.lap('entities')
+    if whitelist_matcher is not None:
+        whitelist_part, nb_terms = whitelist_and_terms(cached, whitelist_matcher, score_batch,
+                                                       tweet_info['complete_raw_text'], stats)
+    if stats is not None:
+        count_tweet(stats, tweet_info, url_infos, whitelist_part)
+
+    row = row_values(tweet_info, TWEET_FIELDS, escape_text) + row_values_escaped(whitelist_part, escape_text)
+    if score_batch is not None:
+        score_batch.add(1, nb_terms, whitelist_part[0] == 'TRUE')
+    if stats is not None:
+        stats.lap('rows')
+    return [row]
+
+
+# The 'urls' field of extract_tweet_row
+def urls_field(url_infos):
+    return ' '.join(','.join([url_info['where_url_found'], url_info['link_type'],
+                              url_info['canonical_url'].replace(' ', '%20')])
+                    for url_info in url_infos)
+
+
+# Values of fields from a dictionary, as a tuple; if escape, with strip_newlines applied to the text fields.
+# Fields missing from the dictionary are ''.
+def row_values(d, fields, escape):
+    if not escape:
+        return tuple([d.get(field, '') for field in fields])
+    return tuple([strip_newlines(d[field]) if field in TEXT_FIELDS and field in d else d.get(field, '')
+                  for field in fields])
+
+
+# (classifier_label, white_terms), as from whitelist_fields, escaped if asked
+def row_values_escaped(whitelist_part, escape):
+    if escape and whitelist_part:
+        return whitelist_part[0], strip_newlines(whitelist_part[1])
+    return whitelist_part
+
+
+class RetweetCache(object):
+    """ Bounded LRU cache, for retweets, of what the extract functions compute from the retweeted status and
+        what it quotes: its ORIGINAL_FIELDS, URLs, complete_raw_text and whitelist labels. Popular statuses get
+        retweeted many times over, and this way each retweet only costs reading its own few fields.
+        Keyed by retweeted_status.id_str, along with the few things about the retweet itself that the
+        cached values depend on (see retweet_key). """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns the entry (a dictionary) for key, creating an empty one if needed.
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            entry = {}
+            if len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+        self.entries[key] = entry   # (now the most recently used)
+        return entry
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                'hit_rate': float(self.hits) / n_lookups if n_lookups else 0.0}
+
+
+# Besides the retweeted status, what's cached depends on whether the retweet itself is marked as a quote and which
+# status (and user) it quotes, and on show_internal_twitter. (It could also depend on the retweet's own ID, via links
+# to it from the original -- but the original was posted before the retweet's ID existed.)
+# Screen names are included since users can change them.
+def retweet_key(t, show_internal_twitter):
+    rt = t['retweeted_status']
+    quote = t.get('quoted_status')
+    rt_quote = rt.get('quoted_status')
+    return (rt['id_str'], rt['user']['screen_name'], t['is_quote_status'], t.get('quoted_status_id_str'),
+            (quote['id_str'], quote['user']['screen_name']) if quote is not None else None,
+            (rt_quote['id_str'], rt_quote['user']['screen_name']) if rt_quote is not None else None,
+            show_internal_twitter)
+
+
+# The RetweetCache entry for t (empty if it wasn't cached yet), or None if t isn't a retweet or there's no cache
+def get_retweet_cache_entry(retweet_cache, t, show_internal_twitter, stats):
+    if retweet_cache is None or 'retweeted_status' not in t:
+        return None
+    entry = retweet_cache.get(retweet_key(t, show_internal_twitter))
+    if stats is not None:
+        stats.count('retweet_cache_hits' if entry else 'retweet_cache_misses')
+    return entry
+
+
+def extract_tweet_info_cached(t, cached):
+    if cached is None:
+        return extract_tweet_info(t)
+    if 'original_info' not in cached:
+        tweet_info = extract_tweet_info(t)
+        cached['original_info'] = dict((field, tweet_info[field]) for field in ORIGINAL_FIELDS)
+        return tweet_info
+    return extract_tweet_info(t, cached['original_info'])
+
+
+# func(*args), or its value stored under name in a RetweetCache entry (stored there first if need be)
+def from_cache(cached, name, func, *args):
+    if cached is None:
+        return func(*args)
+    if name not in cached:
+        cached[name] = func(*args)
+    return cached[name]
+
 
-    python_tweet_date = datetime.datetime.strptime(
-        t["created_at"], "%a %b %d %H:%M:%S +0000 %Y").date()
+def in_date_range(t, earliest_date, latest_date):
+    if earliest_date is None and latest_date is None:
+        return True
+    return date_in_range(t["created_at"], earliest_date, latest_date)
+
+
+# The same check on a raw JSON line, before parsing it: False if its created_at can be read off the start of the line
+# (see tweetData.peek_created_at) and is out of range; True otherwise.
+def line_in_date_range(line, earliest_date, latest_date):
+    if earliest_date is None and latest_date is None:
+        return True
+    created_at = peek_created_at(line)
+    return created_at is None or date_in_range(created_at, earliest_date, latest_date)
+
+
+# Whether a raw JSON line can have any URLs for get_tweet_urls, before parsing it: every URL it uses (from the
+# status, its extended_tweet, retweeted or quoted status) comes with an "expanded_url" key, and in raw JSON that
+# quoted name can only be a key (a quote inside a string value would be escaped).
+def line_has_urls(line):
+    return '"expanded_url"' in line
+
+
+def date_in_range(created_at, earliest_date, latest_date):
+    python_tweet_date = parse_tweet_date(created_at)
     if earliest_date and python_tweet_date < earliest_date:
-        return {}
+        return False
     if latest_date and python_tweet_date > latest_date:
-        return {}
+        return False
+    return True
 
-    ##############################################
 
-    # Get non-URL fields
-    tweet_info = extract_tweet_info(t)
-    if 'reply_to_user_id' in tweet_info:
-        del tweet_info['reply_to_user_id']
+# Returns the values of WHITELIST_FIELDS: (classifier_label, white_terms)
+def whitelist_fields(whitelist_matcher, text):
+    label, white_terms = whitelist_matcher.match(text)
+    return ('TRUE' if label else 'FALSE'), white_terms
+
+
+# whitelist_fields, plus the tweet's naive Bayes terms (found in what's left of the text once the white terms are
+# taken out) for the extract functions' score_batch
+def whitelist_and_scoring_fields(whitelist_matcher, scorer, text):
+    label, white_terms, rest_of_text = whitelist_matcher.match_and_remove(text)
+    return (('TRUE' if label else 'FALSE'), white_terms), scorer.tweet_terms(rest_of_text)
 
+
+# For the extract functions: (whitelist_fields, naive Bayes terms or None without a score_batch), from the retweet
+# cache if possible, timing stages 'whitelist' and 'classifier'
+def whitelist_and_terms(cached, whitelist_matcher, score_batch, text, stats):
+    if score_batch is None:
+        whitelist_part = from_cache(cached, 'whitelist_part', whitelist_fields, whitelist_matcher, text)
+        nb_terms = None
+    else:
+        whitelist_part, nb_terms = from_cache(cached, 'whitelist_scoring', whitelist_and_scoring_fields,
+                                              whitelist_matcher, score_batch.scorer, text)
+    if stats is not None:
+        stats.lap('whitelist' if score_batch is None else 'classifier')
+    return whitelist_part, nb_terms
+
+
+# Counters for one (in-range) tweet, given its tweet_info, URLs and whitelist_fields (if it was checked):
+# retweets, quotes, replies, tweets_with_urls, urls_<link_type>, whitelist_matches
+def count_tweet(stats, tweet_info, url_infos, whitelist_part=()):
+    if tweet_info['retweet_of_tweet_id']:
+        stats.count('retweets')
+    if tweet_info['quote_of_tweet_id']:
+        stats.count('quotes')
+    if tweet_info['reply_to_tweet_id']:
+        stats.count('replies')
+    if url_infos:
+        stats.count('tweets_with_urls')
+    for url_info in url_infos:
+        stats.count('urls_' + url_info['link_type'])
+    if whitelist_part and whitelist_part[0] == 'TRUE':
+        stats.count('whitelist_matches')
+
+
+# Returns the statuses to look in: (t, or its retweeted_status if it's a retweet; the quoted status or None),
+# and the IDs of the tweet and quoted tweet (we skip any links back to these)
+def get_main_and_quoted_status(t):
     rt = t.get('retweeted_status', None)
     quote = t.get('quoted_status', None)
     if quote is None and rt is not None:
         quote = rt.get('quoted_status', None)
 
+    self_and_quoted_ids = [t.get('id_str', '')]
+    if quote is not None:
+        self_and_quoted_ids.append(quote['id_str'])
+
+    return (rt if rt is not None else t), quote, self_and_quoted_ids
+
+
+# Returns one dictionary per URL (fields where_url_found through website), in the order they'll be printed.
+def get_tweet_urls(t, show_internal_twitter=False):
+    rt = t.get('retweeted_status', None)
+    main_status, quote, self_and_quoted_ids = get_main_and_quoted_status(t)
+
     # Get URLs (and media) from { original tweet or retweeted status } and quoted status. (But we'll drop media below.)
-    orig_ents = get_ext_status_ents(t)
-    rt_ents = get_ext_status_ents(rt)
+    main_ents = get_ext_status_ents(main_status)
     quoted_ents = get_ext_status_ents(quote)
 
     if rt is None:
-        urls = [('orig', False, url, '') for url in orig_ents.get('urls', [])] + \
-            [('orig', True, url, '') for url in orig_ents.get('media', [])]
+        urls = [('orig', False, url, '') for url in main_ents.get('urls', [])] + \
+            [('orig', True, url, '') for url in main_ents.get('media', [])]
     else:
-        urls = [('retweeted', False, url, rt['user']['screen_name']) for url in rt_ents.get('urls', [])] + \
-            [('retweeted', True, url, rt['user']['screen_name']) for url in rt_ents.get('media', [])]
+        urls = [('retweeted', False, url, rt['user']['screen_name']) for url in main_ents.get('urls', [])] + \
+            [('retweeted', True, url, rt['user']['screen_name']) for url in main_ents.get('media', [])]
     urls = urls + \
         [('quoted', False, url, quote['user']['screen_name']) for url in quoted_ents.get('urls', [])] + \
         [('quoted', True, url, quote['user']['screen_name']) for url in quoted_ents.get('media', [])]
 
-    # Get IDs of tweet and quoted tweet (we'll skip any links back to these)
-    self_and_quoted_ids = [t.get('id_str', '')]
-    if quote is not None:
-        self_and_quoted_ids.append(quote['id_str'])
-
-    res = []  # all the urls for this tweet
+    res = []
     for url_type, is_media, url_struct, url_orig in urls:
         expanded_url = url_struct.get('expanded_url', None)
         if expanded_url is None or not isinstance(expanded_url, basestring):
             continue
 
-        rec = tweet_info.copy()  # this url
         m = TWEET_URL_PATTERN.match(expanded_url)        # twitter url parts
 
         if m is None:
             # simplest case: external URL
             link_type = 'external'
             domain_match = URL_PATTERN.match(expanded_url)
-            rec.update({
+            rec = {
                 'where_url_found': url_type,
                 'who_url_from': url_orig,
                 'link_type': link_type,
                 'shortened_url': url_struct['url'],
                 'canonical_url': expanded_url,
                 'website': domain_match.group(1) if domain_match is not None else None
-            })
+            }
         else:
             # this is a twitter url
             # url shows the owner and status id, but it's media if there's extra stuff after the status id
@@ -118,30 +405,89 @@ def extract_urls_from_tweet(t, earliest_date=None, latest_date=None,
             # use it only if we want twitter urls and this isn't just a link to the status being quoted
             # nor to the original. (The latter has been seen when user posts their own media but, lacking extended_tweet, the 
             # url only shows a self-loop.)
-            if not show_internal_twitter or (is_tweeted_status and not is_media and
-                                         tweeted_status_id in self_and_quoted_ids and
-                                         (url_type == 'orig' or url_type == 'retweeted')):
+            if not show_internal_twitter or ((url_type == 'orig' or url_type == 'retweeted') and
+                                             is_self_or_quoted_link(m, is_media, self_and_quoted_ids)):
                 continue
 
-            rec.update({
+            rec = {
                 'where_url_found': url_type,
                 'who_url_from': url_orig,
                 'link_type': 'twitter_status' if is_tweeted_status else 'twitter_media',
                 'shortened_url': url_struct['url'],
                 'canonical_url': expanded_url,
                 'website': 'twitter.com'
-            })
+            }
             if oldFormat:
                 rec['author'] = tweeted_status_owner if tweeted_status_owner != 'i / web' else ''
 
-        res.append({k : strip_newlines(v) for k,v in rec.items()})
+        res.append(rec)
 
-    if not len(res) and include_non_url_tweets:
-        res.append({k : strip_newlines(v) for k,v in tweet_info.items()})
-        
     return res
 
 
+# m: TWEET_URL_PATTERN's match on the url
+def is_self_or_quoted_link(m, is_media, self_and_quoted_ids):
+    tweeted_status_owner, tweeted_status_id, tweeted_status_extra = m.groups()
+    is_tweeted_status = (tweeted_status_extra == '' or tweeted_status_extra == '/')
+    return is_tweeted_status and not is_media and tweeted_status_id in self_and_quoted_ids
+
+
+# Builds the text that filter_tweets/politicalFilterURLData.R:constructTweets gives the classifier ("complete_raw_text"):
+# RT prefix, tweet text, a "[QTG @user]" marker if it's a quote, and the quoted text, with every t.co link replaced by
+# its expanded URL. As in R, the link to the quoted status (normally at the end of a quoting tweet) is dropped.
+def construct_complete_raw_text(t, tweet_info):
+    main_status, quote, self_and_quoted_ids = get_main_and_quoted_status(t)
+    tweet_text = expand_status_text(main_status, self_and_quoted_ids)
+    quoted_text = ''
+    quoting = ''
+    if tweet_info['quote_of_user_name']:
+        quoting = '[QTG @' + tweet_info['quote_of_user_name'] + ']'
+        tweet_text = QUOTE_LINK_PATTERN.sub('', tweet_text)
+        if tweet_info['quoted_text'] and quote is not None:
+            quoted_text = expand_status_text(quote, [])
+    return u' '.join([tweet_info['retweet_prefix'], tweet_text, quoting, quoted_text])
+
+
+# A status's text (as get_text_field returns it), with each t.co link replaced by its expanded_url -- or removed,
+# if it links to one of drop_status_ids. Uses the entities' indices, but falls back to searching for the t.co url
+# if they're off (as happens, e.g., after '&amp;').
+def expand_status_text(status, drop_status_ids):
+    text = get_raw_text_field(status)
+    ents = get_ext_status_ents(status)
+
+    replacements = {}   # (start, end) -> new text
+    unplaced = []
+    dropped_link = False
+    for is_media, url_struct in [(False, u) for u in ents.get('urls', [])] + [(True, u) for u in ents.get('media', [])]:
+        short_url = url_struct.get('url', None)
+        expanded_url = url_struct.get('expanded_url', None)
+        if not short_url or expanded_url is None or not isinstance(expanded_url, basestring):
+            continue
+        m = TWEET_URL_PATTERN.match(expanded_url)
+        if m is not None and is_self_or_quoted_link(m, is_media, drop_status_ids):
+            expanded_url = ''
+            dropped_link = True
+        indices = url_struct.get('indices', None)
+        if indices and text[indices[0]:indices[1]] == short_url:
+            replacements[(indices[0], indices[1])] = expanded_url
+        else:
+            unplaced.append((short_url, expanded_url))
+
+    for short_url, expanded_url in unplaced:
+        pos = text.find(short_url)
+        while pos >= 0:
+            span = (pos, pos + len(short_url))
+            if not any(s < span[1] and span[0] < e for s, e in replacements):
+                replacements[span] = expanded_url
+            pos = text.find(short_url, span[1])
+
+    for (start, end), new_text in sorted(replacements.items(), reverse=True):
+        text = text[:start] + new_text + text[end:]
+    if dropped_link:
+        text = text.rstrip()
+    return bad_chars.sub(' ', text)
+
+
 def strip_newlines(x):
     return (unicode(x).replace(u"\r\n",u"   ")
                       .replace(u"\r",u"   ")
@@ -0,0 +1,195 @@
+import os
+import time
+import sqlite3
+import threading
+import ujson as json
+
+# On-disk cache of URL expansions (the dictionaries returned by expandURLs.expand_url), keyed by expanded_url.
+# Backed by a single SQLite file, so it persists between runs and can be shared by several threads and processes.
+#
+# -Successful results are kept for ttl seconds; results containing 'err' (negative caching) for error_ttl seconds.
+# -When the cache holds more than max_entries urls, expired entries and then the least recently used ones are evicted.
+# -Each entry records whether it came from a full fetch or only from resolving redirects (fastOnlyExpandURL, or a
+#  RESOLVE from the fetchPlanner). Lookups say which they need, and a resolve-only entry is a miss for a full fetch
+#  (which then replaces it).
+# -get_or_fetch() makes sure each url is only fetched by one worker at a time: other threads in the same process
+#  wait on the in-progress fetch, and other processes see a claim row in the 'in_flight' table and poll for the result.
+# -Counters are per URLCache object; see stats(). Within get_or_fetch(), misses == number of fetches.
+
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_ERROR_TTL = 24 * 3600
+DEFAULT_MAX_ENTRIES = 5000000
+
+# Fields expandURLs.parse_page adds to a full fetch of an html page (the keys of expandURLs.meta_selectors)
+PARSED_FIELDS = ['description', 'author', 'title', 'canonical_url', 'date_published']
+
+# A claim older than this is assumed to belong to a process that died mid-fetch
+CLAIM_TIMEOUT = 120
+POLL_INTERVAL = 0.1
+
+
+class URLCache(object):
+
+    def __init__(self, path, ttl=DEFAULT_TTL, error_ttl=DEFAULT_ERROR_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max_entries
+        self._puts_since_evict = 0
+        self._reset_process_state()
+        self.counts = {'hits': 0, 'misses': 0, 'expired': 0, 'waits': 0, 'puts': 0, 'evicted': 0}
+
+        db = self._db()
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, result TEXT, is_error INTEGER, "
+                       "fetched_at REAL, expires_at REAL, last_used REAL, fast_only INTEGER NOT NULL DEFAULT 0)")
+            if 'fast_only' not in [column[1] for column in db.execute("PRAGMA table_info(urls)")]:
+                db.execute("ALTER TABLE urls ADD COLUMN fast_only INTEGER NOT NULL DEFAULT 0")
+                # (older entries don't say: take html pages with none of the parsed fields to be resolve-only)
+                db.execute("UPDATE urls SET fast_only = 1 WHERE is_error = 0 AND result LIKE '%\"is_html\":1%' AND " +
+                           " AND ".join("result NOT LIKE '%%\"%s\":%%'" % field for field in PARSED_FIELDS))
+            db.execute("CREATE INDEX IF NOT EXISTS urls_last_used ON urls (last_used)")
+            db.execute("CREATE TABLE IF NOT EXISTS in_flight (url TEXT PRIMARY KEY, owner TEXT, claimed_at REAL)")
+
+    # Called again in any child process that inherits this object through a fork (e.g. a multiprocessing worker)
+    def _reset_process_state(self):
+        self._pid = os.getpid()
+        self.owner = "%s:%d" % (os.uname()[1], self._pid)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._in_progress = {}     # url -> threading.Event, for fetches running in this process
+
+    # sqlite connections can't be shared across threads (or processes), so each thread opens its own
+    def _db(self):
+        if os.getpid() != self._pid:
+            self._reset_process_state()
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=60)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def get(self, url, fast_only=False):
+        """ Returns the cached result for url, or None if it's missing or expired.
+            fast_only: True if a result from only resolving url's redirects will do (else such a result counts
+               as missing). """
+        res = self._lookup(url, fast_only)
+        self._count('hits' if res is not None else 'misses')
+        return res
+
+    def _lookup(self, url, fast_only):
+        db = self._db()
+        now = time.time()
+        row = db.execute("SELECT result, expires_at, fast_only FROM urls WHERE url = ?", (url,)).fetchone()
+        if row is None or (row[2] and not fast_only):
+            return None
+        if row[1] < now:
+            self._count('expired')
+            return None
+        with db:
+            db.execute("UPDATE urls SET last_used = ? WHERE url = ?", (now, url))
+        return json.loads(row[0])
+
+    def put(self, url, result, fast_only=False):
+        """ Stores result for url. fast_only: True if it's from only resolving url's redirects. """
+        db = self._db()
+        now = time.time()
+        is_error = 'err' in result
+        expires_at = now + (self.error_ttl if is_error else self.ttl)
+        with db:
+            db.execute("INSERT OR REPLACE INTO urls (url, result, is_error, fetched_at, expires_at, last_used, "
+                       "fast_only) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (url, json.dumps(result), int(is_error), now, expires_at, now, int(fast_only)))
+        self._count('puts')
+        with self._lock:
+            self._puts_since_evict += 1
+            check_size = self._puts_since_evict >= 1000
+            if check_size:
+                self._puts_since_evict = 0
+        if check_size:
+            self.evict()
+
+    def evict(self):
+        """ Drops expired entries, then least recently used ones, until there are at most max_entries. """
+        db = self._db()
+        with db:
+            n_evicted = db.execute("DELETE FROM urls WHERE expires_at < ?", (time.time(),)).rowcount
+            n_extra = db.execute("SELECT COUNT(*) FROM urls").fetchone()[0] - self.max_entries
+            if n_extra > 0:
+                n_evicted += db.execute("DELETE FROM urls WHERE url IN "
+                                        "(SELECT url FROM urls ORDER BY last_used LIMIT ?)", (n_extra,)).rowcount
+        self._count('evicted', n_evicted)
+
+    def get_or_fetch(self, url, fetch_func, fast_only=False):
+        """ Returns the cached result for url, or calls fetch_func() to get (and store) it.
+            If another thread or process is already fetching url, waits for its result instead.
+            Counts a hit if the result came from the cache (including after waiting), a miss if fetch_func was called.
+            fast_only: True if fetch_func only resolves redirects, so that a result from that will do. """
+        while True:
+            res = self._lookup(url, fast_only)
+            if res is not None:
+                self._count('hits')
+                return res
+
+            # Claim the url within this process
+            with self._lock:
+                event = self._in_progress.get(url)
+                if event is None:
+                    self._in_progress[url] = threading.Event()
+            if event is not None:
+                self._count('waits')
+                event.wait()
+                continue
+
+            try:
+                # ...and across processes
+                if not self._claim(url):
+                    self._count('waits')
+                    self._wait_for_other_process(url)
+                    continue
+                try:
+                    self._count('misses')
+                    res = fetch_func()
+                    self.put(url, res, fast_only)
+                finally:
+                    db = self._db()
+                    with db:
+                        db.execute("DELETE FROM in_flight WHERE url = ? AND owner = ?", (url, self.owner))
+                return res
+            finally:
+                with self._lock:
+                    self._in_progress.pop(url).set()
+
+    def _claim(self, url):
+        db = self._db()
+        now = time.time()
+        with db:
+            db.execute("DELETE FROM in_flight WHERE url = ? AND claimed_at < ?", (url, now - CLAIM_TIMEOUT))
+            return db.execute("INSERT OR IGNORE INTO in_flight (url, owner, claimed_at) VALUES (?, ?, ?)",
+                              (url, self.owner, now)).rowcount == 1
+
+    def _wait_for_other_process(self, url):
+        db = self._db()
+        while db.execute("SELECT 1 FROM in_flight WHERE url = ? AND claimed_at >= ?",
+                         (url, time.time() - CLAIM_TIMEOUT)).fetchone() is not None:
+            time.sleep(POLL_INTERVAL)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        lookups = counts['hits'] + counts['misses']
+        counts['hit_rate'] = float(counts['hits']) / lookups if lookups else 0.0
+        counts['entries'] = self._db().execute("SELECT COUNT(*) FROM urls").fetchone()[0]
+        return counts
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
@@ -0,0 +1,214 @@
+import re
+from collections import deque
+
+# Python version of filter_tweets/textProcessingForClassifier.R:checkForWhitelistTerms(removeWLTerms=T), for labeling
+# tweets as they're extracted. Instead of several big regexes, all whitelist terms are compiled into one
+# Aho-Corasick automaton, so each text is scanned once no matter how long the whitelist gets.
+#
+# Same rules as the R matcher (text and terms are lowercased; a space is prepended to the text):
+#  1. hashtags: '#', then any word characters, then the term. The white term runs to the end of the hashtag.
+#  2. handles: '@' + term, not followed by a word character. The white term is '@term'.
+#  3. free text: term between word boundaries (\b), not preceded by '@', optionally followed by -s or -es.
+#     Spaces in a term also match hyphens (in this rule only). Terms ending in punctuation skip the trailing
+#     boundary check.
+#     If the match is inside a URL (a token starting with http: or https:), the white term is the whole URL.
+# Whitelist terms are literal strings, except that regex escapes are honored the way they were meant:
+# '\.' (or '\\.' as written in the whitelist file) is a literal '.', and a trailing '\b' means "no -s/-es".
+# Word characters are [a-z0-9_], as in R's grepl(perl=T, useBytes=T).
+#
+# Differences from R: white terms are reported without the extra leading character R's pattern captures,
+# and when several terms match at the same position, the longest one is reported.
+
+WORD_CHARS = frozenset(u'abcdefghijklmnopqrstuvwxyz0123456789_')
+URL_TOKEN_PATTERN = re.compile(u'(?<![a-z0-9_])https?:\\S*')
+TERM_ESCAPE_PATTERN = re.compile(r'\\+(.)')
+
+
+def load_whitelist(path):
+    """ Reads whitelist terms, one per line, skipping blank lines (as classifyTweets.R does). """
+    with open(path, 'r') as fin:
+        return [line.rstrip('\r\n').decode('utf8') for line in fin if line.strip()]
+
+
+class WhitelistMatcher(object):
+
+    def __init__(self, terms):
+        self.patterns = []   # pattern id -> (literal, ends_in_punct, allow_suffix, is_hyphen_variant)
+        self.goto = [{}]
+        outputs = [[]]
+
+        seen = set()
+        for term in terms:
+            for pattern in self._term_patterns(term.lower()):
+                if pattern in seen:
+                    continue
+                seen.add(pattern)
+                self.patterns.append(pattern)
+                state = 0
+                for c in pattern[0]:
+                    if c not in self.goto[state]:
+                        self.goto.append({})
+                        outputs.append([])
+                        self.goto[state][c] = len(self.goto) - 1
+                    state = self.goto[state][c]
+                outputs[state].append(len(self.patterns) - 1)
+
+        # Breadth-first: compute failure links, merge outputs along them, and fill in every transition
+        # so that scanning is a single dict lookup per character.
+        alphabet = set(c for state in self.goto for c in state)
+        fail = [0] * len(self.goto)
+        self.delta = [None] * len(self.goto)
+        self.delta[0] = dict((c, self.goto[0].get(c, 0)) for c in alphabet)
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            outputs[state] = outputs[state] + outputs[fail[state]]
+            trans = dict(self.delta[fail[state]])
+            for c, nxt in self.goto[state].iteritems():
+                fail[nxt] = self.delta[fail[state]][c] if state != 0 else 0
+                trans[c] = nxt
+                queue.append(nxt)
+            self.delta[state] = trans
+        self.outputs = [tuple(self.patterns[p] for p in out) for out in outputs]
+
+    # Turns one whitelist term into the literal strings to search for, each with its matching flags.
+    @staticmethod
+    def _term_patterns(term):
+        term = term.strip()
+        allow_suffix = True
+        if term.endswith('\\b'):
+            term = term[:-2].rstrip('\\')
+            allow_suffix = False
+        literal = TERM_ESCAPE_PATTERN.sub(r'\1', term)
+        if not literal:
+            return []
+        ends_in_punct = literal[-1] not in WORD_CHARS
+
+        # space-separated words can also be hyphen-separated (each space independently)
+        variants = [u'']
+        for i, c in enumerate(literal):
+            if c == u' ' and 0 < i < len(literal) - 1 and \
+               literal[i - 1] in WORD_CHARS and literal[i + 1] in WORD_CHARS:
+                variants = [v + u' ' for v in variants] + [v + u'-' for v in variants]
+            else:
+                variants = [v + c for v in variants]
+        return [(v, ends_in_punct, allow_suffix, v != literal) for v in variants]
+
+    def match(self, text):
+        """ Returns (classifier_label, white_terms): whether text contains any whitelist term,
+            and the distinct matched terms, comma-separated (URL matches first, as in R). """
+        text, spans = self._find(text)
+        return self._white_fields(text, spans)
+
+    def match_and_remove(self, text):
+        """ Like match, plus rest_of_text: text (with a space prepended, in its original case) with the matched
+            terms cut out, each leaving a space, as in checkForWhitelistTerms(removeWLTerms=T). The naive Bayes
+            classifier is trained on this. """
+        lower_text, spans = self._find(text)
+        classifier_label, white_terms = self._white_fields(lower_text, spans)
+        text = u' ' + text
+        if not classifier_label:
+            return classifier_label, white_terms, text
+        pieces = []
+        prev = 0
+        for start, end in sorted(spans):
+            pieces.append(text[prev:start])
+            prev = end
+        pieces.append(text[prev:])
+        return classifier_label, white_terms, u' '.join(pieces)
+
+    @staticmethod
+    def _white_fields(text, spans):
+        white_terms = []
+        for start, end in spans:
+            term = text[start:end]
+            if term not in white_terms:
+                white_terms.append(term)
+        return len(white_terms) > 0, u', '.join(white_terms)
+
+    # Returns the lowercased text (with a space prepended) and the (start, end) of each match in it that makes
+    # a white term: URLs first, then other matches left to right.
+    def _find(self, text):
+        text = u' ' + text.lower()
+        n = len(text)
+        url_spans = [(m.start(), m.end()) for m in URL_TOKEN_PATTERN.finditer(text)]
+
+        url_terms = []          # (start, end) of URLs containing a match
+        matched_urls = set()    # indices into url_spans
+        candidates = []         # (start, end) of non-URL matches
+        span_idx = 0
+        delta = self.delta
+        outputs = self.outputs
+        state = 0
+        for end in xrange(n):
+            state = delta[state].get(text[end], 0)
+            if not outputs[state]:
+                continue
+            end += 1
+            while span_idx < len(url_spans) and url_spans[span_idx][1] < end:
+                span_idx += 1
+            in_url = span_idx < len(url_spans) and url_spans[span_idx][0] <= end - 1
+
+            for literal, ends_in_punct, allow_suffix, is_hyphen_variant in outputs[state]:
+                start = end - len(literal)
+                before = text[start - 1] if start > 0 else u' '
+                word_end = self._word_match_end(text, start, end, literal, ends_in_punct, allow_suffix)
+
+                if in_url and url_spans[span_idx][0] < start:
+                    # URL rule: needs the same boundaries as free text, but no check for a preceding '@'
+                    if word_end is not None and not ends_in_punct:
+                        if span_idx not in matched_urls:
+                            matched_urls.add(span_idx)
+                            url_terms.append(url_spans[span_idx])
+                        continue
+
+                # (a trailing \b in the term applies to the hashtag and handle rules too)
+                ends_at_boundary = end == n or text[end] not in WORD_CHARS
+                hashtag_start = None
+                if not is_hyphen_variant and (allow_suffix or ends_at_boundary):
+                    hashtag_start = self._hashtag_start(text, start)
+                if hashtag_start is not None:
+                    hashtag_end = end
+                    while hashtag_end < n and text[hashtag_end] in WORD_CHARS:
+                        hashtag_end += 1
+                    candidates.append((hashtag_start, hashtag_end))
+                elif before == u'@':
+                    if ends_at_boundary and not is_hyphen_variant:
+                        candidates.append((start - 1, end))
+                elif word_end is not None:
+                    candidates.append((start, word_end))
+
+        # Drop matches inside URLs already reported whole; keep the leftmost (then longest) non-overlapping ones
+        spans = list(url_terms)
+        last_end = -1
+        for start, end in sorted(candidates, key=lambda c: (c[0], -c[1])):
+            if start < last_end or any(s <= start < e for s, e in url_terms):
+                continue
+            spans.append((start, end))
+            last_end = end
+        return text, spans
+
+    # Returns where a free-text match ends (after any -s/-es), or None if it fails the boundary checks.
+    @staticmethod
+    def _word_match_end(text, start, end, literal, ends_in_punct, allow_suffix):
+        before = text[start - 1] if start > 0 else u' '
+        if before == u'@' or (before in WORD_CHARS) == (literal[0] in WORD_CHARS):
+            return None
+        if ends_in_punct:
+            return end
+        suffixes = (u'es', u's', u'') if allow_suffix else (u'',)
+        for suffix in suffixes:
+            suffix_end = end + len(suffix)
+            if text.startswith(suffix, end) and (suffix_end == len(text) or text[suffix_end] not in WORD_CHARS):
+                return suffix_end
+        return None
+
+    # If a match starting at text[start] follows a '#' (with only word characters between), returns the position of the '#'.
+    @staticmethod
+    def _hashtag_start(text, start):
+        i = start - 1
+        while i >= 0 and text[i] in WORD_CHARS:
+            i -= 1
+        if i >= 0 and text[i] == u'#':
+            return i
+        return None
@@ -0,0 +1,133 @@
+import sys
+import gzip
+import time
+import random
+import urlparse
+import argparse
+import threading
+import BaseHTTPServer
+import SocketServer
+import ujson as json
+
+
+# Local stand-in for Twitter's statuses/user_timeline endpoint, for trying out and testing harvest_timelines.py without
+# credentials. Serves the tweets in the given JSON files (e.g. from generate_synthetic_data.py), grouped into
+# timelines by user, with the real endpoint's paging (count, since_id, max_id, the newest 3200 tweets only) and
+# rate limiting (x-rate-limit-* headers, 429 once a window's requests are used up). Unknown accounts get a 404.
+# --error-rate makes some requests fail with a 503, and --latency slows every request down.
+#
+# Usage: python fake_timeline_api.py [options] <tweets.json.gz> [<tweets2.json.gz> ...]
+# then point harvest_timelines.py at it with --api-url http://localhost:<port>/1.1 (any bearer token will do).
+# Restarting it with more files adds tweets, as if the accounts had kept tweeting.
+
+TIMELINE_PATH = '/1.1/statuses/user_timeline.json'
+MAX_COUNT = 200
+MAX_TIMELINE = 3200   # how far back user_timeline goes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve tweets from JSON files as a fake user_timeline endpoint.")
+    parser.add_argument('inputs', nargs='+', metavar='tweets.json.gz')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--limit', type=int, default=1500, help="requests per rate limit window (default %(default)s)")
+    parser.add_argument('--window', type=float, default=900, help="seconds per window (default %(default)s)")
+    parser.add_argument('--latency', type=float, default=0, help="seconds added to each request")
+    parser.add_argument('--error-rate', type=float, default=0, help="fraction of requests that get a 503")
+    args = parser.parse_args()
+
+    timelines = load_timelines(args.inputs)
+    sys.stderr.write("Serving %d timelines on port %d\n" % (len(timelines), args.port))
+    server = TimelineServer(('127.0.0.1', args.port), TimelineHandler)
+    server.timelines = timelines
+    server.limiter = RateLimiter(args.limit, args.window)
+    server.latency = args.latency
+    server.error_rate = args.error_rate
+    server.serve_forever()
+
+
+# {lowercased screen name: list of (id, JSON line), newest first}
+def load_timelines(paths):
+    timelines = {}
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as fin:
+            for line in fin:
+                line = line.strip()
+                if not line:
+                    continue
+                tweet = json.loads(line)
+                timelines.setdefault(tweet['user']['screen_name'].lower(), {})[tweet['id']] = line
+    return dict((name, sorted(tweets.iteritems(), reverse=True)) for name, tweets in timelines.iteritems())
+
+
+class RateLimiter(object):
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self.reset = time.time() + window
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Returns (whether the request is allowed, remaining, reset time). """
+        with self.lock:
+            now = time.time()
+            if now >= self.reset:
+                self.reset = now + self.window
+                self.used = 0
+            allowed = self.used < self.limit
+            if allowed:
+                self.used += 1
+            return allowed, self.limit - self.used, int(self.reset)
+
+
+class TimelineServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TimelineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        if url.path != TIMELINE_PATH:
+            return self.respond(404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist.'}]})
+        time.sleep(self.server.latency)
+        allowed, remaining, reset = self.server.limiter.take()
+        headers = {'x-rate-limit-limit': self.server.limiter.limit, 'x-rate-limit-remaining': remaining,
+                   'x-rate-limit-reset': reset}
+        if not allowed:
+            return self.respond(429, {'errors': [{'code': 88, 'message': 'Rate limit exceeded'}]}, headers)
+        if random.random() < self.server.error_rate:
+            return self.respond(503, {'errors': [{'code': 130, 'message': 'Over capacity'}]}, headers)
+
+        params = dict(urlparse.parse_qsl(url.query))
+        timeline = self.server.timelines.get(params.get('screen_name', '').lower())
+        if timeline is None:
+            return self.respond(404, {'errors': [{'code': 34, 'message': 'Sorry, that page does not exist.'}]},
+                                headers)
+        count = min(int(params.get('count', 20)), MAX_COUNT)
+        since_id = int(params.get('since_id', 0))
+        max_id = int(params['max_id']) if 'max_id' in params else None
+        page = [line for tweet_id, line in timeline[:MAX_TIMELINE]
+                if tweet_id > since_id and (max_id is None or tweet_id <= max_id)][:count]
+        self.respond(200, '[' + ','.join(page) + ']', headers)
+
+    def respond(self, status, body, headers={}):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import codecs
 import tweepy
 import sys
+import time
 import twitterAuthLDF
 import ujson as json
 
@@ -0,0 +1,277 @@
+import sys
+import gzip
+import random
+import argparse
+import datetime
+import ujson as json
+
+
+# Writes a gzipped file of fake (but realistically shaped) tweet JSON, one status per line, for testing and
+# benchmarking the code in ../extract_text_from_json/ without Twitter credentials.
+#
+# The mix of tweet types is configurable: original tweets, replies, retweets, quotes and retweets of quotes.
+# Some fraction of statuses use 'extended_tweet' payloads (as the streaming API sends for long tweets), and
+# tweets can carry external links, media, and links to other statuses. Retweets and quotes draw their originals
+# from a pool with a few very popular ("viral") statuses, as in a real stream.
+#
+# Usage: python generate_synthetic_data.py [options] <outFile.json.gz>
+
+DEFAULT_MIX = 'original=45,reply=10,retweet=30,quote=8,retweet_of_quote=7'
+
+WORDS = ('the of and to a in is it you that he was for on are with as his they be at one have this from or had by '
+         'word but what some we can out other were all there when up use your how said an each she which do their time '
+         'if will way about many then them write would like so these her long make thing see him two has look more day '
+         'could go come did number sound no most people my over know water than call first who may down side been now '
+         'find any new work part take get place made live where after back little only round man year came show every '
+         'good me give our under name very through just form sentence great think say help low line differ turn cause '
+         'much mean before move right boy old too same tell does set three want air well also play small end put home '
+         'read hand port large spell add even land here must big high such follow act why ask men change went light').split()
+# a sprinkling of topical words, so that whitelist matching has something to find
+TOPIC_WORDS = ['Clinton', 'Trump', 'debate', 'election', 'senate', 'GOP', 'voters', 'Pence', 'Kaine', 'president']
+HASHTAGS = ['#tbt', '#news', '#debatenight', '#ImWithHer', '#MAGA', '#NBA', '#music', '#love', '#Election2016', '#food']
+DOMAINS = ['www.nytimes.com', 'www.cnn.com', 'www.foxnews.com', 'www.washingtonpost.com', 'bit.ly', 'www.youtube.com',
+           'www.instagram.com', 'www.breitbart.com', 'www.huffingtonpost.com', 'www.buzzfeed.com', 'example.org']
+TWITTER_DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a gzipped file of synthetic tweet JSON.")
+    parser.add_argument('output', metavar='outFile.json.gz')
+    parser.add_argument('-n', '--num-tweets', type=int, default=100000)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="relative weights of tweet types (default %(default)s)")
+    parser.add_argument('--extended-fraction', type=float, default=0.3,
+                        help="fraction of statuses delivered as truncated text + extended_tweet (default %(default)s)")
+    parser.add_argument('--url-fraction', type=float, default=0.5, help="fraction of statuses with external links")
+    parser.add_argument('--media-fraction', type=float, default=0.15, help="fraction of statuses with a photo")
+    parser.add_argument('--status-link-fraction', type=float, default=0.05,
+                        help="fraction of statuses linking to some other status")
+    parser.add_argument('--num-users', type=int, default=20000)
+    parser.add_argument('--viral-pool', type=int, default=2000,
+                        help="number of distinct statuses that get retweeted/quoted (popularity is skewed)")
+    parser.add_argument('--start-date', default='2016-10-01', help="YYYY-MM-DD; tweets span one day from here")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    mix = []
+    for item in args.mix.split(','):
+        kind, weight = item.split('=')
+        mix.append((kind.strip(), float(weight)))
+
+    gen = TweetGenerator(args)
+    with gzip.open(args.output, 'wb') as fout:
+        for i in xrange(args.num_tweets):
+            fout.write(dump_status(gen.make_tweet(weighted_choice(gen.rng, mix))) + '\n')
+    sys.stderr.write("Wrote %d tweets to %s\n" % (args.num_tweets, args.output))
+
+
+# JSON for a status with created_at and then id as its first keys, as Twitter writes them (the extractor reads them
+# off the start of the line when it can: tweetData.peek_created_at and peek_tweet_id). ujson would put them anywhere.
+def dump_status(tweet):
+    rest = dict(tweet)
+    first = json.dumps(rest.pop('created_at'))
+    tweet_id = rest.pop('id')
+    return '{"created_at":' + first + ',"id":' + str(tweet_id) + (',' + json.dumps(rest)[1:] if rest else '}')
+
+
+def weighted_choice(rng, weighted_items):
+    r = rng.uniform(0, sum(w for item, w in weighted_items))
+    for item, w in weighted_items:
+        r -= w
+        if r <= 0:
+            return item
+    return weighted_items[-1][0]
+
+
+class TweetGenerator(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.next_id = 780000000000000000
+        self.start = datetime.datetime.strptime(args.start_date, '%Y-%m-%d')
+        self.users = [self.make_user(i) for i in xrange(args.num_users)]
+        # originals to retweet/quote: index i is chosen with probability ~ 1/(i+1)
+        self.pool = []
+        self.pool_weights = [1.0 / (i + 1) for i in xrange(args.viral_pool)]
+        self.pool_cumulative = []
+        total = 0.0
+        for w in self.pool_weights:
+            total += w
+            self.pool_cumulative.append(total)
+
+    def new_id(self):
+        self.next_id += self.rng.randint(1, 5000)
+        return self.next_id
+
+    def make_user(self, i):
+        screen_name = 'user_%d_%s' % (i, ''.join(self.rng.choice('abcdefghijklmnopqrstuvwxyz') for j in range(5)))
+        return {
+            'id': 10000 + i, 'id_str': str(10000 + i), 'name': screen_name.title(), 'screen_name': screen_name,
+            'location': self.rng.choice(['', 'New York, NY', 'Ohio', 'Earth', 'London']),
+            'url': None, 'description': self.words(self.rng.randint(0, 25)), 'protected': False, 'verified': self.rng.random() < 0.01,
+            'followers_count': self.rng.randint(0, 100000), 'friends_count': self.rng.randint(0, 5000),
+            'listed_count': self.rng.randint(0, 500), 'favourites_count': self.rng.randint(0, 50000),
+            'statuses_count': self.rng.randint(1, 100000), 'created_at': 'Mon Mar 02 17:03:11 +0000 2009',
+            'utc_offset': None, 'time_zone': None, 'geo_enabled': False, 'lang': 'en', 'contributors_enabled': False,
+            'is_translator': False, 'profile_background_color': 'C0DEED',
+            'profile_background_image_url': 'http://abs.twimg.com/images/themes/theme1/bg.png',
+            'profile_background_image_url_https': 'https://abs.twimg.com/images/themes/theme1/bg.png',
+            'profile_background_tile': False, 'profile_link_color': '1DA1F2', 'profile_sidebar_border_color': 'C0DEED',
+            'profile_sidebar_fill_color': 'DDEEF6', 'profile_text_color': '333333', 'profile_use_background_image': True,
+            'profile_image_url': 'http://pbs.twimg.com/profile_images/%d/abc_normal.jpg' % i,
+            'profile_image_url_https': 'https://pbs.twimg.com/profile_images/%d/abc_normal.jpg' % i,
+            'default_profile': True, 'default_profile_image': False, 'following': None, 'follow_request_sent': None,
+            'notifications': None,
+        }
+
+    def words(self, n):
+        out = []
+        for j in xrange(n):
+            r = self.rng.random()
+            if r < 0.05:
+                out.append(self.rng.choice(TOPIC_WORDS))
+            elif r < 0.08:
+                out.append(self.rng.choice(HASHTAGS))
+            elif r < 0.10:
+                out.append('@' + self.rng.choice(self.users)['screen_name'] if hasattr(self, 'users') else '@someone')
+            else:
+                out.append(self.rng.choice(WORDS))
+        return ' '.join(out)
+
+    def created_at(self):
+        return (self.start + datetime.timedelta(seconds=self.rng.randint(0, 86399))).strftime(TWITTER_DATE_FORMAT)
+
+    def short_url(self):
+        return 'https://t.co/' + ''.join(self.rng.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+                                         for j in range(10))
+
+    # A status (no retweet/quote nesting yet). links: list of (kind, expanded_url) appended to the text.
+    def make_status(self, user, text, links, extended=None):
+        status_id = self.new_id()
+        if extended is None:
+            extended = self.rng.random() < self.args.extended_fraction
+
+        entities = {'hashtags': [], 'symbols': [], 'user_mentions': [], 'urls': []}
+        media = []
+        for kind, expanded_url in links:
+            short = self.short_url()
+            text += ' '
+            indices = [len(text), len(text) + len(short)]
+            text += short
+            if kind == 'media':
+                media.append({'id': status_id, 'id_str': str(status_id), 'indices': indices, 'url': short,
+                              'media_url': 'http://pbs.twimg.com/media/abc.jpg',
+                              'media_url_https': 'https://pbs.twimg.com/media/abc.jpg',
+                              'display_url': 'pic.twitter.com/abc', 'expanded_url': expanded_url, 'type': 'photo',
+                              'sizes': {'small': {'w': 680, 'h': 510, 'resize': 'fit'}, 'thumb': {'w': 150, 'h': 150, 'resize': 'crop'}}})
+            else:
+                entities['urls'].append({'url': short, 'expanded_url': expanded_url,
+                                         'display_url': expanded_url.split('://', 1)[-1][:26], 'indices': indices})
+        if media:
+            entities['media'] = media
+
+        tweet = {
+            'created_at': self.created_at(), 'id': status_id, 'id_str': str(status_id),
+            'source': '<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
+            'in_reply_to_status_id': None, 'in_reply_to_status_id_str': None, 'in_reply_to_user_id': None,
+            'in_reply_to_user_id_str': None, 'in_reply_to_screen_name': None, 'user': user, 'geo': None,
+            'coordinates': None, 'place': None, 'contributors': None, 'is_quote_status': False,
+            'retweet_count': 0, 'favorite_count': 0, 'favorited': False, 'retweeted': False,
+            'possibly_sensitive': False, 'filter_level': 'low', 'lang': 'en', 'timestamp_ms': '1475280000000',
+        }
+        if extended and len(text) > 140:
+            tweet['truncated'] = True
+            tweet['text'] = text[:139] + u'\u2026'
+            tweet['entities'] = {'hashtags': [], 'symbols': [], 'user_mentions': [],
+                                 'urls': [u for u in entities['urls'] if u['indices'][1] <= 139]}
+            tweet['extended_tweet'] = {'full_text': text, 'display_text_range': [0, len(text)], 'entities': entities}
+            if media:
+                tweet['extended_tweet']['extended_entities'] = {'media': media}
+        else:
+            tweet['truncated'] = False
+            tweet['text'] = text
+            tweet['entities'] = entities
+            if media:
+                tweet['extended_entities'] = {'media': media}
+        return tweet
+
+    def random_links(self, user):
+        links = []
+        if self.rng.random() < self.args.url_fraction:
+            for j in xrange(1 if self.rng.random() < 0.85 else 2):
+                links.append(('url', 'http://%s/%d/%s.html' % (self.rng.choice(DOMAINS), self.rng.randint(2010, 2016),
+                                                                '-'.join(self.rng.choice(WORDS) for k in range(4)))))
+        if self.rng.random() < self.args.status_link_fraction:
+            other = self.rng.choice(self.users)
+            links.append(('url', 'https://twitter.com/%s/status/%d' % (other['screen_name'], self.new_id())))
+        if self.rng.random() < self.args.media_fraction:
+            links.append(('media', 'https://twitter.com/%s/status/%d/photo/1' % (user['screen_name'], self.new_id())))
+        return links
+
+    def original(self):
+        user = self.rng.choice(self.users)
+        return self.make_status(user, self.words(self.rng.randint(4, 45)), self.random_links(user))
+
+    def quote_of(self, quoted):
+        user = self.rng.choice(self.users)
+        permalink = 'https://twitter.com/%s/status/%s' % (quoted['user']['screen_name'], quoted['id_str'])
+        tweet = self.make_status(user, self.words(self.rng.randint(2, 30)), self.random_links(user) + [('url', permalink)])
+        tweet['is_quote_status'] = True
+        tweet['quoted_status_id'] = quoted['id']
+        tweet['quoted_status_id_str'] = quoted['id_str']
+        tweet['quoted_status'] = quoted
+        return tweet
+
+    def retweet_of(self, original):
+        user = self.rng.choice(self.users)
+        prefix = 'RT @' + original['user']['screen_name'] + ': '
+        full_text = original.get('extended_tweet', {}).get('full_text', original['text'])
+        tweet = self.make_status(user, (prefix + full_text)[:140], [], extended=False)
+        tweet['entities'] = {'hashtags': [], 'symbols': [], 'user_mentions': [], 'urls': []}
+        tweet['retweeted_status'] = original
+        tweet['is_quote_status'] = original['is_quote_status']
+        if original['is_quote_status']:
+            tweet['quoted_status_id'] = original['quoted_status_id']
+            tweet['quoted_status_id_str'] = original['quoted_status_id_str']
+        return tweet
+
+    # an original (or a quote, if want_quote) from the pool of popular statuses
+    def popular_status(self, want_quote):
+        r = self.rng.uniform(0, self.pool_cumulative[-1])
+        lo, hi = 0, len(self.pool_cumulative) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.pool_cumulative[mid] < r:
+                lo = mid + 1
+            else:
+                hi = mid
+        key = (lo, want_quote)
+        while len(self.pool) <= lo:
+            self.pool.append({})
+        if key not in self.pool[lo]:
+            self.pool[lo][key] = self.quote_of(self.original()) if want_quote else self.original()
+        return self.pool[lo][key]
+
+    def make_tweet(self, kind):
+        if kind == 'original':
+            return self.original()
+        if kind == 'reply':
+            tweet = self.original()
+            replied = self.popular_status(False)
+            tweet['in_reply_to_status_id'] = replied['id']
+            tweet['in_reply_to_status_id_str'] = replied['id_str']
+            tweet['in_reply_to_user_id_str'] = replied['user']['id_str']
+            tweet['in_reply_to_screen_name'] = replied['user']['screen_name']
+            return tweet
+        if kind == 'retweet':
+            return self.retweet_of(self.popular_status(False))
+        if kind == 'quote':
+            return self.quote_of(self.popular_status(False))
+        if kind == 'retweet_of_quote':
+            return self.retweet_of(self.popular_status(True))
+        raise ValueError("unknown tweet type '%s' in --mix" % kind)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+import os
+import sys
+import glob
+import time
+import gzip
+import collections
+import signal
+import argparse
+import threading
+import requests
+import ujson as json
+
+
+# Harvests the timelines of a long list of accounts, for data sets bigger than gather_sample_data.py's.
+#
+# -Requests are scheduled across accounts: a timeline is fetched one page (200 tweets) at a time, and after each page
+#  its account goes to the back of the queue. So every account gets its newest tweets before any gets deep history,
+#  and one prolific account doesn't hold up the rest. --threads requests are in flight at once.
+# -Rate limits are read off every response (x-rate-limit-remaining, x-rate-limit-reset). Once the window's remaining
+#  budget is down to --reserve, all threads wait until the window resets (not a fixed 15 minutes); so does a 429.
+#  Other errors are retried with backoff; accounts that are protected, suspended or gone are noted in the state and
+#  passed over.
+# -State per account is kept in --state-file: since_id, the newest tweet of the last complete pass over the timeline,
+#  and during a pass, max_id, how far back it has got. A rerun carries on with an interrupted pass where it stopped,
+#  and otherwise only fetches tweets newer than since_id.
+# -Tweets go, one JSON status per line, into gzip files in outDir (<prefix>-<start time>-<n>.json.gz) that rotate
+#  at --rotate-mb and at every checkpoint (--checkpoint-interval). Each file is written as <name>.part and renamed when
+#  closed, and the state is saved right after, so the saved state only ever covers tweets in finished files. Leftover
+#  .part files from a run that died are deleted on restart (their tweets are fetched again).
+#
+# The API is reached with plain HTTP at --api-url, using app-only auth (--bearer-token-file), so it can also be a local
+# fake (fake_timeline_api.py). Without a bearer token, it goes through tweepy and twitterAuthLDF instead, as
+# gather_sample_data.py does (one request at a time, since a tweepy API object can't be shared by threads).
+#
+# Usage: python harvest_timelines.py [options] <accounts.txt> <outDir>
+# accounts.txt: one screen name per line (blank lines and lines starting with # are ignored).
+# E.g., against the fake API:
+#   python fake_timeline_api.py ../example_data/synthetic.json.gz --port 8001 &
+#   python harvest_timelines.py --api-url http://localhost:8001/1.1 accounts.txt harvested/
+
+DEFAULT_API_URL = 'https://api.twitter.com/1.1'
+PAGE_SIZE = 200   # the most user_timeline returns at once
+RATE_LIMIT_WINDOW = 15 * 60
+# seconds to wait past a window's reset time, for clock skew
+RESET_MARGIN = 2
+# statuses for which an account is passed over for the rest of the run (not authorized / protected, suspended,
+# doesn't exist)
+ACCOUNT_ERRORS = (401, 403, 404)
+# How often (seconds) waiting threads check for a stop signal
+POLL_INTERVAL = 0.5
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Harvest the timelines of many accounts into rotating gzip files, "
+                                                 "fetching only new tweets on reruns.")
+    parser.add_argument('accounts', metavar='accounts.txt', help="screen names, one per line")
+    parser.add_argument('out_dir', metavar='outDir')
+    parser.add_argument('--state-file', help="per-account checkpoints (default: <outDir>/harvest_state.json)")
+    parser.add_argument('--api-url', default=DEFAULT_API_URL, help="default %(default)s")
+    parser.add_argument('--bearer-token-file',
+                        help="file holding an app-only bearer token; without one, tweepy and twitterAuthLDF are used")
+    parser.add_argument('--threads', type=int, default=4, help="requests in flight at once (default %(default)s)")
+    parser.add_argument('--reserve', type=int, default=0,
+                        help="requests of each rate limit window to leave unused, e.g. for other programs sharing "
+                             "the credentials (default %(default)s)")
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help="retries of a failing request before an account is left for the next run")
+    parser.add_argument('--rotate-mb', type=float, default=100,
+                        help="start a new output file once one has this many (compressed) MB (default %(default)s)")
+    parser.add_argument('--checkpoint-interval', type=float, default=60, metavar='SECONDS',
+                        help="close the current output file and save the state this often (default %(default)s)")
+    parser.add_argument('--prefix', default='timelines', help="start of output file names (default %(default)s)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    state_path = args.state_file or os.path.join(args.out_dir, 'harvest_state.json')
+    for part_path in glob.glob(os.path.join(args.out_dir, args.prefix + '-*.json.gz.part')):
+        sys.stderr.write("Removing unfinished " + part_path + " (its tweets will be fetched again)\n")
+        os.remove(part_path)
+
+    if args.bearer_token_file:
+        with open(args.bearer_token_file, 'r') as fin:
+            source = HTTPTimelines(args.api_url, fin.read().strip())
+    else:
+        import twitterAuthLDF
+        source = TweepyTimelines(twitterAuthLDF.getAPIobj())
+        args.threads = 1
+
+    harvester = Harvester(source, read_accounts(args.accounts), load_state(state_path), state_path,
+                          RotatingGzipWriter(args.out_dir, args.prefix, int(args.rotate_mb * 1024 * 1024)),
+                          RateBudget(args.reserve), args.max_retries)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: harvester.stopping.set())
+    harvester.run(args.threads, args.checkpoint_interval)
+
+
+def read_accounts(path):
+    accounts = []
+    seen = set()
+    with open(path, 'r') as fin:
+        for line in fin:
+            name = line.strip().lstrip('@')
+            if name and not name.startswith('#') and name.lower() not in seen:
+                seen.add(name.lower())
+                accounts.append(name)
+    return accounts
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as fin:
+        return json.load(fin)
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message, rate=None):
+        """ status: HTTP status, or None if there was no response. rate: (remaining, reset) if the response had them. """
+        Exception.__init__(self, '%s %s' % (status, message))
+        self.status = status
+        self.rate = rate
+
+
+# (remaining, reset) from a response's rate limit headers, or None
+def read_rate_limit(headers):
+    try:
+        return int(headers['x-rate-limit-remaining']), int(headers['x-rate-limit-reset'])
+    except (KeyError, ValueError):
+        return None
+
+
+# A timeline source has get_timeline(screen_name, since_id, max_id), which returns (list of statuses as dicts,
+# (remaining, reset) or None) for one page, newest first, and raises ApiError.
+class HTTPTimelines(object):
+
+    def __init__(self, api_url, bearer_token, timeout=30):
+        self.url = api_url.rstrip('/') + '/statuses/user_timeline.json'
+        self.headers = {'Authorization': 'Bearer ' + bearer_token}
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def get_timeline(self, screen_name, since_id=None, max_id=None):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()   # (one per thread, for keep-alive)
+        params = {'screen_name': screen_name, 'count': PAGE_SIZE, 'tweet_mode': 'extended', 'include_rts': 'true'}
+        if since_id is not None:
+            params['since_id'] = since_id
+        if max_id is not None:
+            params['max_id'] = max_id
+        try:
+            response = self.local.session.get(self.url, params=params, headers=self.headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ApiError(None, type(e).__name__)
+        rate = read_rate_limit(response.headers)
+        if response.status_code != 200:
+            raise ApiError(response.status_code, response.text[:200], rate)
+        try:
+            return json.loads(response.content), rate
+        except ValueError:
+            raise ApiError(response.status_code, "Unreadable response", rate)
+
+
+class TweepyTimelines(object):
+
+    def __init__(self, api):
+        self.api = api
+
+    def get_timeline(self, screen_name, since_id=None, max_id=None):
+        import tweepy
+        try:
+            statuses = self.api.user_timeline(screen_name=screen_name, count=PAGE_SIZE, since_id=since_id,
+                                              max_id=max_id, tweet_mode='extended', include_rts=True)
+        except tweepy.TweepError as e:
+            response = getattr(e, 'response', None)
+            if response is None:
+                raise ApiError(None, str(e))
+            raise ApiError(response.status_code, str(e), read_rate_limit(response.headers))
+        response = getattr(self.api, 'last_response', None)
+        return [status._json for status in statuses], read_rate_limit(response.headers) if response is not None else None
+
+
+class RateBudget(object):
+    """ The current rate limit window, shared by all threads: acquire() before each request, update() with what each
+        response says. """
+
+    def __init__(self, reserve=0):
+        self.reserve = reserve
+        self.remaining = None   # (unknown until a response says)
+        self.reset = 0
+        self.cond = threading.Condition()
+        self.seconds_waited = 0.0
+        self.announced_reset = None
+
+    def acquire(self, stopping):
+        """ Waits until the window has a request to spare, and takes it. Returns False if stopping was set first. """
+        with self.cond:
+            while True:
+                if stopping.is_set():
+                    return False
+                now = time.time()
+                if self.remaining is not None and now >= self.reset + RESET_MARGIN:
+                    self.remaining = None   # a new window; its budget comes with the next response
+                if self.remaining is None or self.remaining > self.reserve:
+                    break
+                if self.announced_reset != self.reset:
+                    sys.stderr.write("(Rate limit reached -- waiting %d s for the next window)\n" %
+                                     (self.reset + RESET_MARGIN - now))
+                    self.announced_reset = self.reset
+                self.cond.wait(min(POLL_INTERVAL, self.reset + RESET_MARGIN - now))
+                self.seconds_waited += time.time() - now
+            if self.remaining is not None:
+                self.remaining -= 1
+            return True
+
+    def update(self, remaining, reset):
+        with self.cond:
+            if reset > self.reset or self.remaining is None:
+                self.reset = max(reset, self.reset)
+                self.remaining = remaining
+            elif reset == self.reset:
+                # (responses can arrive out of order; the lowest count is the latest)
+                self.remaining = min(self.remaining, remaining)
+            self.cond.notify_all()
+
+    def exhausted(self, reset=None):
+        """ After a 429: nothing left until reset (default: a window from now). """
+        self.update(0, reset if reset is not None else int(time.time()) + RATE_LIMIT_WINDOW)
+
+
+class Harvester(object):
+    """ Fetches the accounts' timelines page by page with a pool of threads, taking accounts round-robin. """
+
+    def __init__(self, source, accounts, state, state_path, writer, budget, max_retries=3):
+        """ state: dict of per-account state (from load_state()), updated as it goes and saved to state_path. """
+        self.source = source
+        self.state = state
+        self.state_path = state_path
+        self.writer = writer
+        self.budget = budget
+        self.max_retries = max_retries
+        self.pending = collections.deque((name, 0) for name in accounts)   # (account, retries of its next page)
+        self.in_flight = 0
+        # guards everything but source and budget
+        self.cond = threading.Condition()
+        self.stopping = threading.Event()
+        self.counts = {'requests': 0, 'errors': 0, 'tweets': 0, 'files': 0, 'accounts_done': 0,
+                       'accounts_passed_over': 0, 'accounts_left': 0}
+
+    def run(self, n_threads, checkpoint_interval):
+        start = time.time()
+        threads = [threading.Thread(target=self.work) for i in xrange(n_threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        next_checkpoint = time.time() + checkpoint_interval
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(POLL_INTERVAL)
+            if time.time() >= next_checkpoint:
+                self.checkpoint()
+                self.report(start)
+                next_checkpoint = time.time() + checkpoint_interval
+        self.checkpoint()
+        with self.cond:
+            self.counts['accounts_left'] += len(self.pending)
+        self.report(start)
+
+    def work(self):
+        while True:
+            item = self.next_account()
+            if item is None:
+                return
+            next_item = None
+            try:
+                next_item = self.fetch_page(*item)
+            finally:
+                self.done_with(next_item)
+
+    # The next (account, retries) to fetch a page for, or None once there's nothing left or it's stopping.
+    def next_account(self):
+        with self.cond:
+            while not self.pending and self.in_flight > 0 and not self.stopping.is_set():
+                self.cond.wait(POLL_INTERVAL)
+            if not self.pending or self.stopping.is_set():
+                return None
+            self.in_flight += 1
+            return self.pending.popleft()
+
+    def done_with(self, next_item):
+        with self.cond:
+            self.in_flight -= 1
+            if next_item is not None:
+                self.pending.append(next_item)
+            self.cond.notify_all()
+
+    def fetch_page(self, name, retries):
+        """ Fetches and writes the next page of name's timeline. Returns (name, retries) to queue it again if there's
+            more to fetch, or None. """
+        with self.cond:
+            account = self.state.setdefault(name.lower(), {})
+            since_id, max_id = account.get('since_id'), account.get('max_id')
+        if not self.budget.acquire(self.stopping):
+            return name, retries
+        try:
+            statuses, rate = self.source.get_timeline(name, since_id, max_id)
+        except ApiError as e:
+            return self.failed(name, retries, account, e)
+        if rate is not None:
+            self.budget.update(*rate)
+
+        with self.cond:
+            self.counts['requests'] += 1
+            account.pop('error', None)
+            if not statuses:
+                # the pass over this timeline is complete
+                if 'newest' in account:
+                    account['since_id'] = account.pop('newest')
+                account.pop('max_id', None)
+                account['harvested_at'] = int(time.time())
+                self.counts['accounts_done'] += 1
+                return None
+            file_full = self.writer.write_lines(json.dumps(status) + '\n' for status in statuses)
+            ids = [status['id'] for status in statuses]
+            account['newest'] = max(ids + [account.get('newest', 0)])
+            account['max_id'] = min(ids) - 1
+            self.counts['tweets'] += len(statuses)
+            if file_full:
+                self.checkpoint()
+        return name, 0
+
+    def failed(self, name, retries, account, e):
+        if e.rate is not None:
+            self.budget.update(*e.rate)
+        if e.status == 429:
+            self.budget.exhausted(e.rate[1] if e.rate is not None else None)
+            return name, retries
+        with self.cond:
+            self.counts['requests'] += 1
+            self.counts['errors'] += 1
+            if e.status in ACCOUNT_ERRORS:
+                account['error'] = e.status
+                self.counts['accounts_passed_over'] += 1
+        if e.status in ACCOUNT_ERRORS:
+            sys.stderr.write("Passing over " + name + ": " + str(e) + "\n")
+            return None
+        if retries < self.max_retries:
+            self.stopping.wait(2 ** retries)
+            return name, retries + 1
+        sys.stderr.write("Leaving " + name + " for the next run: " + str(e) + "\n")
+        with self.cond:
+            self.counts['accounts_left'] += 1
+        return None
+
+    def checkpoint(self):
+        """ Finishes the current output file, then saves the state. """
+        with self.cond:
+            if self.writer.close_file() is not None:
+                self.counts['files'] += 1
+            write_atomically(self.state_path, json.dumps(self.state))
+
+    def report(self, start):
+        with self.cond:
+            counts = dict(self.counts)
+        sys.stderr.write(("%(requests)d requests (%(errors)d errors), %(tweets)d tweets in %(files)d files; accounts: "
+                          "%(accounts_done)d done, %(accounts_passed_over)d passed over, %(accounts_left)d left for the "
+                          "next run" % counts) +
+                         "; %.0f s, %.0f thread-seconds waiting on rate limits\n" %
+                         (time.time() - start, self.budget.seconds_waited))
+
+
+class RotatingGzipWriter(object):
+    """ Writes lines into a series of gzip files, <out_dir>/<prefix>-<YYYYmmdd-HHMMSS>-<n>.json.gz, each of them
+        written as <name>.part until close_file(). """
+
+    def __init__(self, out_dir, prefix, max_bytes):
+        self.stem = os.path.join(out_dir, prefix + '-' + time.strftime('%Y%m%d-%H%M%S'))
+        self.max_bytes = max_bytes
+        self.n_files = 0
+        self.path = None
+        self.raw = None
+        self.fout = None
+
+    def write_lines(self, lines):
+        """ Returns whether the current file has now reached max_bytes (compressed). """
+        if self.fout is None:
+            self.path = '%s-%04d.json.gz' % (self.stem, self.n_files)
+            self.n_files += 1
+            self.raw = open(self.path + '.part', 'wb')
+            self.fout = gzip.GzipFile(filename=self.path, mode='wb', fileobj=self.raw)
+        for line in lines:
+            self.fout.write(line)
+        return self.raw.tell() >= self.max_bytes
+
+    def close_file(self):
+        """ Finishes the current file, if there is one, and returns its name. """
+        if self.fout is None:
+            return None
+        self.fout.close()
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        self.raw.close()
+        self.fout = None
+        os.rename(self.path + '.part', self.path)
+        return self.path
+
+
+def write_atomically(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(data)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.rename(tmp_path, path)
+
+
+if __name__ == "__main__":
+    main()